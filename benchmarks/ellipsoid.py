@@ -0,0 +1,39 @@
+"""Geodetic (WGS84) conversions against the spherical earth conversions
+
+usage:
+    python benchmarks/ellipsoid.py [npoints]
+
+The default of 10^7 points needs about 3 GB of memory.
+"""
+import sys
+import numpy as np
+
+from kamodo_geometry.coordinates import get_transform, geodetic_to_ecef, ecef_to_geodetic
+from suite import time_call
+
+
+def main(npoints=10**7):
+    random = np.random.RandomState(0)
+    hvec = np.stack((random.uniform(-180, 180, npoints),
+                     random.uniform(-90, 90, npoints),
+                     random.uniform(0, 4e7, npoints)), axis=-1)
+    xvec = geodetic_to_ecef(hvec)
+    out = np.empty_like(hvec)
+
+    print('{:>22} {:>10} {:>10} {:>8}'.format('conversion', 'spherical', 'wgs84', 'ratio'))
+    for src, dst, vec in (('geographic', 'cartesian', hvec),
+                          ('cartesian', 'geographic', xvec),
+                          ('geographic', 'spherical', hvec)):
+        sphere = get_transform(src, dst)
+        ellipsoid = get_transform(src, dst, ellipsoid='wgs84')
+        t_sphere = time_call(lambda: sphere(vec, out=out))
+        t_ellipsoid = time_call(lambda: ellipsoid(vec, out=out))
+        print('{:>22} {:>10.3f} {:>10.3f} {:>8.2f}'.format(
+            '{}->{}'.format(src, dst), t_sphere, t_ellipsoid, t_ellipsoid/t_sphere))
+
+    error = np.abs(geodetic_to_ecef(ecef_to_geodetic(xvec)) - xvec).max()
+    print('max round trip position error {:.2e} m'.format(error))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
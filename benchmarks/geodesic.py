@@ -0,0 +1,44 @@
+"""Blocked great-circle distances, nearest-k and within-radius queries
+
+usage:
+    python benchmarks/geodesic.py [max_size] [workers]
+
+Sizes run in powers of 10 up to max_size (default 10^5) stations against
+as many ground track points, i.e. up to 10^10 pairs. The full distance
+matrix is never held: pairwise is timed as a blocked nearest-distance
+reduction, and peak traced memory is reported for each case.
+"""
+import sys
+import numpy as np
+
+from kamodo_geometry.geodesic import iter_pairwise, nearest, within, random_positions
+from suite import measure
+
+
+def min_distance(stations, track, workers):
+    result = np.empty(len(stations))
+    for rows, d in iter_pairwise(stations, track, workers=workers):
+        result[rows] = d.min(axis=1)
+    return result
+
+
+def main(max_size=10**5, workers=1):
+    random = np.random.RandomState(0)
+    print('{:>8} {:>14} {:>10} {:>10}'.format('size', 'case', 'seconds', 'peak MB'))
+    size = 10
+    while size <= max_size:
+        stations = random_positions(size, random)
+        track = random_positions(size, random)
+        cases = [
+            ('pairwise min', lambda: min_distance(stations, track, workers)),
+            ('nearest k=4', lambda: nearest(stations, track, k=4, workers=workers)),
+            ('within 100km', lambda: within(stations, track, 1e5, workers=workers)),
+        ]
+        for name, func in cases:
+            seconds, peak = measure(func)
+            print('{:>8} {:>14} {:>10.4f} {:>10.1f}'.format(size, name, seconds, peak/2**20))
+        size *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,32 @@
+"""Thread scaling of ParallelTransformer on large position arrays
+
+usage:
+    python benchmarks/parallel_scaling.py [n_points] [max_workers]
+"""
+import os
+import sys
+import numpy as np
+
+from kamodo_geometry.coordinates import Cartesian
+from kamodo_geometry.parallel import ParallelTransformer
+from suite import time_call
+
+
+def main(n=10**7, max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    xvec = np.random.RandomState(0).uniform(-1e7, 1e7, (n, 3))
+    out = np.empty_like(xvec)
+    cartesian = Cartesian()
+
+    print('{:>8} {:>8} {:>10} {:>8}'.format('kernel', 'workers', 'seconds', 'speedup'))
+    for name in ('rvec', 'hvec'):
+        serial = None
+        for workers in range(1, max_workers + 1):
+            with ParallelTransformer(cartesian, workers=workers) as cart:
+                seconds = time_call(lambda: cart.convert(name, xvec, out))
+            serial = serial or seconds
+            print('{:>8} {:>8} {:>10.4f} {:>8.2f}'.format(name, workers, seconds, serial/seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,36 @@
+"""Separable trig evaluation of space.shell against a full meshgrid evaluation
+
+usage:
+    python benchmarks/shell_trig.py [ntheta] [nphi]
+"""
+import sys
+import numpy as np
+
+from kamodo_geometry.space import one_dimensional, separable_shell, dense_shell
+from suite import time_call
+
+
+def main(ntheta=2000, nphi=4000):
+    r_ = one_dimensional(0., 2., ntheta, 'linear', 10)
+    theta_ = one_dimensional(0, np.pi, ntheta, 'linear', 1)
+    phi_ = one_dimensional(0, 2*np.pi, nphi, 'linear', 1)
+    cases = [
+        ('theta-phi', (1.0, theta_, phi_), 0),
+        ('r-theta', (r_, theta_, 0.), 2),
+        ('r-phi', (r_, np.pi/3, phi_), 1),
+    ]
+    print('{:>10} {:>8} {:>10} {:>10} {:>8} {:>10}'.format(
+        'shell', 'squeeze', 'dense', 'separable', 'speedup', 'max diff'))
+    for name, axes, fixed in cases:
+        for squeeze in (True, False):
+            kwargs = dict(fixed=fixed, squeeze=squeeze, indexing='xy')
+            dense = time_call(lambda: dense_shell(*axes, **kwargs))
+            separable = time_call(lambda: separable_shell(*axes, **kwargs))
+            diff = max(np.abs(a - b).max() for a, b in zip(
+                dense_shell(*axes, **kwargs), separable_shell(*axes, **kwargs)))
+            print('{:>10} {:>8} {:>10.4f} {:>10.4f} {:>8.2f} {:>10.2e}'.format(
+                name, str(squeeze), dense, separable, dense/separable, diff))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
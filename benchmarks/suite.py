@@ -0,0 +1,210 @@
+"""Time and peak memory of every coordinate conversion and grid generator
+
+Each case is run at sizes of 1 point up to --max-size points in powers of 10.
+Results may be saved as a baseline and later runs compared against it; any
+case slower or larger than the baseline by more than --threshold (and, for
+times, by more than --time-tolerance seconds) is reported as a regression
+and the script exits with status 1. No network access is needed.
+
+benchmarks/baseline.json holds the default sizes on one development machine.
+Timings depend on the hardware, so save a baseline on the machine the
+comparisons will run on.
+
+usage:
+    python benchmarks/suite.py --save benchmarks/baseline.json
+    python benchmarks/suite.py --baseline benchmarks/baseline.json --threshold 0.25
+    python benchmarks/suite.py --max-size 100000000 --filter cartesian
+
+Sizes of 10^8 points need several GB of memory for the (N, 3) inputs alone.
+"""
+import argparse
+import gc
+import json
+import re
+import sys
+import timeit
+import tracemalloc
+import numpy as np
+from kamodo import get_args
+
+from kamodo_geometry.coordinates import Spherical, Cartesian, Geographic
+from kamodo_geometry import space
+
+
+# argument ranges for the component functions of each coordinate system
+argument_ranges = dict(
+    r=(0.5, 2.), theta=(0, np.pi), phi=(0, 2*np.pi),
+    x=(-1., 1.), y=(-1., 1.), z=(-1., 1.),
+    x_=(-1., 1.), y_=(-1., 1.), z_=(-1., 1.),
+    lon=(-180., 180.), lat=(-90., 90.), alt=(0., 1e6),
+)
+
+vector_components = dict(
+    rvec=('r', 'theta', 'phi'),
+    xvec=('x', 'y', 'z'),
+    hvec=('lon', 'lat', 'alt'),
+)
+
+
+def random_argument(name, size, random):
+    if name in vector_components:
+        return np.stack([random_argument(_, size, random)
+                         for _ in vector_components[name]], axis=-1)
+    low, high = argument_ranges[name]
+    return random.uniform(low, high, size)
+
+
+def conversion_cases():
+    """yield (name, setup) for every function registered on the coordinate classes
+
+    setup(size) returns a no-argument callable performing the conversion.
+    """
+    for coords in (Spherical(), Cartesian(), Geographic()):
+        # each function is registered under its name and its signature
+        for key in sorted(set(str(_).split('(')[0] for _ in coords)):
+            func = coords[key]
+            args = [_ for _ in get_args(func) if _ != 'out']
+
+            def setup(size, func=func, args=args):
+                random = np.random.RandomState(0)
+                kwargs = {_: random_argument(_, size, random) for _ in args}
+                return lambda: func(**kwargs)
+            yield '{}.{}'.format(type(coords).__name__.lower(), key), setup
+
+
+def grid_shape(size, ndim):
+    """number of points per axis giving approximately size points in total"""
+    return max(1, int(round(size**(1./ndim))))
+
+
+def generator_cases():
+    """yield (name, setup) for every grid generator in space.py"""
+    one_d = dict(x='n', y='n', z='n')
+    for name, n in one_d.items():
+        yield 'space.{}'.format(name), lambda size, name=name, n=n: (
+            lambda: getattr(space, name)(**{n: size}))
+
+    for name in ('xy', 'xz', 'yz'):
+        def setup(size, name=name):
+            n = grid_shape(size, 2)
+            axes = dict(xy=('nx', 'ny'), xz=('nx', 'nz'), yz=('ny', 'nz'))[name]
+            return lambda: getattr(space, name)(**{_: n for _ in axes})
+        yield 'space.{}'.format(name), setup
+
+    for plane in ('xy', 'xz', 'yz'):
+        def setup(size, plane=plane):
+            n = grid_shape(size, 2)
+            return lambda: space.planar(plane=plane, nx=n, ny=n, nz=n)
+        yield 'space.planar[{}]'.format(plane), setup
+
+    shells = [('shell', space.shell, ('theta-phi', 'r-theta', 'r-phi'), 'r', 'theta', 'phi'),
+              ('shell_geo', space.shell_geo, ('lat-lon', 'h-lat', 'h-lon'), 'h', 'lat', 'lon')]
+    for name, generator, modes, a, b, c in shells:
+        for mode in modes:
+            def setup(size, generator=generator, mode=mode, a=a, b=b, c=c):
+                n = grid_shape(size, 2)
+                kwargs = {'shell': mode, 'n' + a: n, 'n' + b: n, 'n' + c: n}
+                return lambda: generator(**kwargs)
+            yield 'space.{}[{}]'.format(name, mode), setup
+
+
+def time_call(func, repeat=3):
+    """median wall time per call of func over repeat samples
+
+    Each sample loops func for at least 0.2 s, as sized by
+    timeit.Timer.autorange, so short calls are not dominated by timer noise.
+    """
+    timer = timeit.Timer(func)
+    number = timer.autorange()[0]
+    return float(np.median(timer.repeat(repeat, number)))/number
+
+
+def measure(run, repeat=3):
+    """median wall time per call and peak traced memory of one call"""
+    def clear_run():
+        space.grid_cache.clear()
+        run()
+
+    seconds = time_call(clear_run, repeat)
+    space.grid_cache.clear()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run_suite(max_size=10**6, repeat=3, pattern=None):
+    """benchmark every case at sizes 1, 10, ... max_size
+
+    returns a dict mapping 'case[size]' to dict(time=seconds, peak=bytes)
+    """
+    sizes = [10**i for i in range(int(np.log10(max_size)) + 1)]
+    cases = list(conversion_cases()) + list(generator_cases())
+    results = {}
+    for name, setup in cases:
+        if pattern is not None and re.search(pattern, name) is None:
+            continue
+        for size in sizes:
+            run = setup(size)
+            seconds, peak = measure(run, repeat)
+            key = '{}[{}]'.format(name, size)
+            results[key] = dict(time=seconds, peak=peak)
+            print('{:<40} {:>12.6f} s {:>14,d} B'.format(key, seconds, peak))
+            del run
+    return results
+
+
+def regressions(results, baseline, threshold=0.25, time_tolerance=1e-3, peak_tolerance=4096):
+    """cases slower or using more peak memory than baseline by more than threshold
+
+    Increases must also exceed time_tolerance seconds or peak_tolerance bytes,
+    below which run to run noise dominates.
+    """
+    found = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result['time'] > base['time']*(1 + threshold) + time_tolerance:
+            found.append((key, 'time', base['time'], result['time']))
+        if result['peak'] > base['peak']*(1 + threshold) + peak_tolerance:
+            found.append((key, 'peak', base['peak'], result['peak']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--max-size', type=float, default=10**6,
+                        help='largest number of points per case (default 1e6)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', default=None, help='regex selecting case names')
+    parser.add_argument('--save', default=None, help='write results to this json file')
+    parser.add_argument('--baseline', default=None, help='compare against this json file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative increase over the baseline')
+    parser.add_argument('--time-tolerance', type=float, default=1e-3,
+                        help='allowed absolute increase in seconds on top of the threshold')
+    args = parser.parse_args(argv)
+
+    results = run_suite(int(args.max_size), args.repeat, args.filter)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold, args.time_tolerance)
+        for key, metric, before, after in found:
+            print('REGRESSION {:<40} {} {:.4g} -> {:.4g} ({:+.0%})'.format(
+                key, metric, before, after, after/before - 1))
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
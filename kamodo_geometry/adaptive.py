@@ -0,0 +1,360 @@
+from kamodo import get_defaults
+import asyncio
+import numpy as np
+
+from kamodo_geometry import space
+from kamodo_geometry.space import generator_entry, one_dimensional, optional, plot_dict
+
+
+# # Adaptive sampling
+#
+# Uniform `planar`, `shell` and cut plane grids must be fine everywhere to resolve thin
+# structures such as the magnetopause or a current sheet. Here the surface
+# is sampled on a coarse grid with the same parameters as the generator,
+# and only cells whose corner values vary by more than a tolerance are split
+# into four, up to max_level times. Points are shared between neighboring
+# cells and each level is evaluated in a single vectorized call.
+
+def axis_parameters(params, name):
+    """(start, stop, n, space, base) of axis name in generator parameters"""
+    return tuple(params[_.format(name)] for _ in ('{}_1', '{}_2', 'n{}', '{}space', '{}base'))
+
+
+def cut_surface(u, v, w):
+    """surface of the xy, xz and yz generators, passing through w if given"""
+    def surface(**params):
+        fixed = params[w]
+
+        def position(uu, vv):
+            coords = {u: uu, v: vv, w: fixed}
+            return tuple(coords[_] for _ in 'xyz' if coords[_] is not None)
+
+        return axis_parameters(params, u), axis_parameters(params, v), position
+    return surface
+
+
+def planar_surface(plane, **params):
+    """axes and (u, v) -> (x, y, z) mapping of a planar() plane"""
+    u, v = plane
+    w = next(_ for _ in 'xyz' if _ not in plane)
+    return cut_surface(u, v, w)(**params)
+
+
+def shell_surface(shell, r_min, r_max, nr, r, rspace, rbase,
+                  theta_min, theta_max, ntheta, theta, phi_min, phi_max, nphi, phi,
+                  **ignored):
+    """axes and (u, v) -> (x, y, z) mapping of a shell() surface"""
+    axes = dict(r=(r_min, r_max, nr, rspace, rbase),
+                theta=(theta_min, theta_max, ntheta, 'linear', 1),
+                phi=(phi_min, phi_max, nphi, 'linear', 1))
+    fixed = dict(r=r, theta=theta, phi=phi)
+    u, v = shell.split('-')
+
+    def position(uu, vv):
+        coords = dict(fixed, **{u: uu, v: vv})
+        rr, ttheta, pphi = coords['r'], coords['theta'], coords['phi']
+        sin_theta = np.sin(ttheta)
+        return rr*sin_theta*np.cos(pphi), rr*np.sin(pphi)*sin_theta, rr*np.cos(ttheta)
+
+    return axes[u], axes[v], position
+
+
+surfaces = {space.planar: planar_surface, space.shell: shell_surface,
+            space.xy: cut_surface('x', 'y', 'z'), space.xz: cut_surface('x', 'z', 'y'),
+            space.yz: cut_surface('y', 'z', 'x')}
+
+
+def surface(grid_fn, grid_kwargs):
+    """axes, (u, v) mapping and resolved parameters of a 2-d generator"""
+    mapping = generator_entry(surfaces, grid_fn)
+    if mapping is None:
+        raise NotImplementedError('adaptive sampling of {} not supported'.format(
+            getattr(grid_fn, '__name__', grid_fn)))
+    params = {k: optional(v) for k, v in dict(get_defaults(grid_fn), **grid_kwargs).items()}
+    return mapping(**params) + (params,)
+
+
+class Quadtree(object):
+    """adaptively sampled surface
+
+    points are the (x, y, z) positions of all evaluated points and values
+    the function evaluated there. cells holds the leaf cells as (m, 4)
+    indices of their corner points, counterclockwise in (u, v), with their
+    refinement level in levels. u and v are the surface parameters of the
+    points, e.g. theta and phi for a theta-phi shell.
+    """
+    def __init__(self, points, values, u, v, cells, levels):
+        self.points = points
+        self.values = values
+        self.u = u
+        self.v = v
+        self.cells = cells
+        self.levels = levels
+
+    @property
+    def evaluations(self):
+        return len(self.values)
+
+    def triangles(self):
+        """(2m, 3) corner indices splitting each leaf cell, e.g. for a plotly Mesh3d"""
+        return np.concatenate((self.cells[:, [0, 1, 2]], self.cells[:, [0, 2, 3]]))
+
+
+def adaptive(func, grid_fn, tol, max_level=4, **grid_kwargs):
+    """sample func on the surface of grid_fn, refining where it varies by more than tol
+
+    example:
+        >>> tree = adaptive(k.rho, shell, tol=0.1, max_level=5, ntheta=17, nphi=33, r=10)
+        >>> x, y, z = tree.points
+        >>> i, j, k = tree.triangles().T
+        >>> go.Mesh3d(x=x, y=y, z=z, i=i, j=j, k=k, intensity=tree.values)
+
+    grid_fn is planar, shell, xy, xz or yz, with grid_kwargs selecting the surface and
+    its coarsest sampling as for the generator itself. A cell is split while
+    the range of func over its corners exceeds tol, so features smaller than
+    a coarse cell may go undetected. The finest cells are 2**max_level times
+    smaller than the coarse ones.
+    """
+    u_axis, v_axis, position, _ = surface(grid_fn, grid_kwargs)
+
+    # fine lattice on which the corners of all cells lie
+    step = 2**max_level
+    u_1, u_2, nu, u_space, u_base = u_axis
+    v_1, v_2, nv, v_space, v_base = v_axis
+    u = one_dimensional(u_1, u_2, (nu - 1)*step + 1, u_space, u_base)
+    v = one_dimensional(v_1, v_2, (nv - 1)*step + 1, v_space, v_base)
+
+    keys = np.empty(0, dtype=np.int64)
+    values = None
+
+    def evaluate(new):
+        i, j = np.divmod(new, len(v))
+        grid = np.broadcast_arrays(*position(u[i], v[j]))
+        return np.broadcast_to(func(**plot_dict(func, grid)), new.shape)
+
+    i0, j0 = [_.ravel()*step for _ in np.meshgrid(np.arange(nu - 1), np.arange(nv - 1),
+                                                  indexing='ij')]
+    leaves = []
+    for level in range(max_level + 1):
+        size = step >> level
+        corners = np.stack([i0*len(v) + j0, (i0 + size)*len(v) + j0,
+                            (i0 + size)*len(v) + j0 + size, i0*len(v) + j0 + size])
+
+        # evaluate the corners not shared with coarser cells in one call
+        new = np.setdiff1d(corners, keys)
+        if len(new):
+            new_values = evaluate(new)
+            keys = np.concatenate((keys, new))
+            values = new_values if values is None else np.concatenate((values, new_values))
+            order = np.argsort(keys, kind='stable')
+            keys, values = keys[order], values[order]
+
+        f = values[np.searchsorted(keys, corners)]
+        split = (f.max(axis=0) - f.min(axis=0) > tol) & (level < max_level)
+        leaves.append((corners[:, ~split], np.full((~split).sum(), level)))
+
+        half = size // 2
+        i0 = np.concatenate([i0[split], i0[split] + half, i0[split], i0[split] + half])
+        j0 = np.concatenate([j0[split], j0[split], j0[split] + half, j0[split] + half])
+        if len(i0) == 0:
+            break
+
+    i, j = np.divmod(keys, len(v))
+    points = tuple(np.broadcast_arrays(*position(u[i], v[j])))
+    leaf_corners, levels = zip(*leaves)
+    cells = np.searchsorted(keys, np.concatenate(leaf_corners, axis=1).T)
+    levels = np.concatenate(levels)
+    return Quadtree(points, values, u[i], v[j], cells, levels)
+
+
+# # Progressive sampling
+#
+# Dashboards can draw a coarse result long before the full grid is
+# evaluated. Each level subsamples the full-resolution axes of the generator
+# with half the stride of the previous one, always keeping the last point,
+# so every level contains the points of the levels before it and only the
+# new rows and columns are evaluated.
+
+def level_indices(n, levels):
+    """nested axis indices of each level, the last being range(n)"""
+    strides = [2**k for k in reversed(range(levels))]
+    return [np.union1d(np.arange(0, n, stride), [n - 1]) for stride in strides]
+
+
+def take(a, rows, cols):
+    """a[rows, cols] of a 2-d array broadcastable along length 1 axes"""
+    if np.ndim(a) == 0:
+        return a
+    rows = rows if np.shape(a)[0] > 1 else slice(None)
+    cols = cols if np.shape(a)[1] > 1 else slice(None)
+    if isinstance(rows, slice) or isinstance(cols, slice):
+        return a[rows, cols]
+    return a[np.ix_(rows, cols)]
+
+
+def progressive(func, grid_fn, levels=4, **grid_kwargs):
+    """yield (grid, values) of func on grid_fn's surface, from coarse to full resolution
+
+    example:
+        >>> for (x, y, z), rho in progressive(k.rho, shell, levels=5, ntheta=2000, nphi=4000):
+        ...     figure.data[0].update(x=x, y=y, z=z, surfacecolor=rho)
+
+    Level k takes every 2**(levels-1-k)-th point along each axis of
+    grid_fn(**grid_kwargs), plus the last one. grid has the layout of the
+    generator's (squeezed) output and the last level matches it. func is
+    evaluated once per point overall: values of earlier levels are reused.
+    """
+    u_axis, v_axis, position, params = surface(grid_fn, grid_kwargs)
+    if not params.get('squeeze', True):
+        raise NotImplementedError('progressive sampling requires squeeze')
+    transpose = params.get('indexing', 'xy') == 'xy'
+    u = one_dimensional(*u_axis)
+    v = one_dimensional(*v_axis)
+
+    def evaluate(grid, rows=slice(None), cols=slice(None)):
+        """func on the rows and cols (index arrays or slices) of a broadcastable grid"""
+        grid = [take(_, rows, cols) for _ in grid]
+        return np.broadcast_to(func(**plot_dict(func, grid)), np.broadcast(*grid).shape)
+
+    previous = None
+    for rows, cols in zip(level_indices(len(u), levels), level_indices(len(v), levels)):
+        grid = position(u[rows][:, np.newaxis], v[cols][np.newaxis, :])
+        if previous is None:
+            values = evaluate(grid)
+        else:
+            # old points, then the new columns of old rows and all of the new rows
+            prev_rows, prev_cols, prev_values = previous
+            old_rows = np.flatnonzero(np.isin(rows, prev_rows))
+            old_cols = np.flatnonzero(np.isin(cols, prev_cols))
+            new_rows = np.setdiff1d(np.arange(len(rows)), old_rows)
+            new_cols = np.setdiff1d(np.arange(len(cols)), old_cols)
+            values = np.empty((len(rows), len(cols)), dtype=prev_values.dtype)
+            values[np.ix_(old_rows, old_cols)] = prev_values
+            values[np.ix_(old_rows, new_cols)] = evaluate(grid, old_rows, new_cols)
+            values[new_rows] = evaluate(grid, new_rows)
+        previous = rows, cols, values
+        grid = tuple(np.broadcast_to(_, values.shape) if np.ndim(_) else _ for _ in grid)
+        if transpose:
+            yield tuple(_.T if np.ndim(_) else _ for _ in grid), values.T
+        else:
+            yield grid, values
+
+
+async def progressive_async(func, grid_fn, levels=4, executor=None, **grid_kwargs):
+    """async iterator over progressive(), evaluating each level in executor
+
+    The event loop stays responsive while levels are computed, e.g. in a
+    dashboard callback. executor=None uses the loop's default executor.
+    """
+    loop = asyncio.get_running_loop()
+    pyramid = progressive(func, grid_fn, levels=levels, **grid_kwargs)
+    done = object()
+    while True:
+        level = await loop.run_in_executor(executor, next, pyramid, done)
+        if level is done:
+            return
+        yield level
+
+
+def test_adaptive_planar():
+    from kamodo_geometry.space import planar
+
+    def front(x, y, z):
+        return np.tanh((x - 0.3 - 0.2*y)/0.005)
+
+    tree = adaptive(front, planar, tol=0.1, max_level=5, nx=9, ny=9)
+    uniform = (8*32 + 1)**2
+    assert tree.evaluations < uniform/10
+
+    # every point is evaluated once, and includes the coarse grid of planar
+    x, y, z = tree.points
+    assert np.allclose(tree.values, front(x, y, z))
+    assert len(set(zip(x, y))) == tree.evaluations
+    coarse = planar(nx=9, ny=9)
+    assert set(zip(coarse[0].ravel().round(12), coarse[1].ravel().round(12))) <= \
+        set(zip(x.round(12), y.round(12)))
+
+    # leaves tile the plane and are only coarse where the function is smooth
+    f = tree.values[tree.cells]
+    variation = f.max(axis=1) - f.min(axis=1)
+    assert ((variation <= 0.1) | (tree.levels == 5)).all()
+    area = (x[tree.cells[:, 2]] - x[tree.cells[:, 0]])*(y[tree.cells[:, 2]] - y[tree.cells[:, 0]])
+    assert np.isclose(area.sum(), 1) and (area > 0).all()
+    assert tree.levels.max() == 5 and tree.levels.min() == 0
+    assert tree.triangles().shape == (2*len(tree.cells), 3)
+
+
+def test_adaptive_shell():
+    import functools
+    from kamodo_geometry.space import shell
+
+    def sheet(x, y, z):
+        return np.tanh((z - 0.3)/0.05)
+
+    tree = adaptive(sheet, shell, tol=0.2, max_level=4, r=2., ntheta=9, nphi=17)
+    x, y, z = tree.points
+    assert np.allclose(np.sqrt(x**2 + y**2 + z**2), 2)
+    theta = tree.u[tree.cells]
+    crossing = (theta.min(axis=1) < np.arccos(0.15)) & (theta.max(axis=1) > np.arccos(0.15))
+    assert crossing.any() and (tree.levels[crossing] == 4).all()
+    assert (tree.levels[~crossing] < 4).any()
+
+    # generators are recognized through wrappers, not by name
+    @functools.wraps(shell)
+    def wrapped(*args, **kwargs):
+        return shell(*args, **kwargs)
+    wrapped.__name__ = 'renamed'
+    same = adaptive(sheet, wrapped, tol=0.2, max_level=4, r=2., ntheta=9, nphi=17)
+    assert np.array_equal(same.values, tree.values)
+
+    def planar(**kwargs):
+        return shell(**kwargs)
+    try:
+        adaptive(sheet, planar, tol=0.1)
+    except NotImplementedError:
+        pass
+    else:
+        raise AssertionError('dispatch must not go by name')
+    try:
+        adaptive(sheet, lambda: None, tol=0.1)
+    except NotImplementedError:
+        pass
+    else:
+        raise AssertionError('only 2-d surfaces are supported')
+
+
+def test_progressive():
+    from kamodo_geometry.space import shell, planar, xy
+    calls = []
+
+    def rho(x, y, z):
+        calls.append(np.size(np.broadcast(x, y, z)))
+        return np.exp(-x**2)*y + z
+
+    pyramid = list(progressive(rho, shell, levels=4, r=2., ntheta=41, nphi=62))
+    assert [values.shape for _, values in pyramid] == [(9, 6), (17, 11), (32, 21), (62, 41)]
+    assert sum(calls) == 62*41
+
+    # the last level is the generator's grid, and levels are nested
+    grid, values = pyramid[-1]
+    full = shell(r=2., ntheta=41, nphi=62)
+    assert all(np.allclose(a, b) for a, b in zip(grid, full))
+    assert np.allclose(values, rho(*full))
+    (x, y, z), coarse = pyramid[1]
+    assert np.allclose(coarse, rho(x, y, z))
+    assert np.allclose(coarse[:-1, :-1], values[:-1:4, :-1:4])
+
+    grid, values = list(progressive(rho, planar, levels=3, nx=9, ny=7, indexing='ij'))[-1]
+    assert values.shape == (9, 7)
+    assert all(np.allclose(a, b) for a, b in zip(grid, planar(nx=9, ny=7, indexing='ij')))
+
+    def area(x, y):
+        return x*y
+
+    async def collect():
+        return [values async for _, values in progressive_async(area, xy, levels=2, nx=5, ny=3)]
+
+    levels = asyncio.run(collect())
+    assert [_.shape for _ in levels] == [(2, 3), (3, 5)]
+    x_, y_ = xy(nx=5, ny=3)
+    assert np.allclose(levels[-1], x_*y_)
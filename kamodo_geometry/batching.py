@@ -0,0 +1,206 @@
+import asyncio
+import numpy as np
+
+
+# # Batched conversions
+#
+# Many small, concurrent conversion requests are coalesced into a single
+# vectorized call. Requests made on the event loop are queued per conversion
+# until max_batch positions are waiting or max_delay seconds have passed,
+# then converted together on an executor thread and the results are fanned
+# back out to the awaiting callers.
+
+class ConversionBatcher(object):
+    """asyncio front-end coalescing concurrent conversions of a coordinate object
+
+    example:
+        >>> async with ConversionBatcher(Cartesian(), max_batch=4096, max_delay=0.002) as cart:
+        ...     hvec = await cart.hvec((x, y, z))
+
+    Each request is a single position or a (..., 3) array and resolves to an
+    array of the same shape. At most max_pending requests may be queued or in
+    flight; further callers wait until earlier results are delivered.
+    executor is passed to loop.run_in_executor (None uses the default pool).
+    """
+    def __init__(self, coords, max_batch=1024, max_delay=0.001, max_pending=10000,
+                 executor=None):
+        if max_batch < 1:
+            raise ValueError('max_batch must be positive, got {}'.format(max_batch))
+        self.coords = coords
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.executor = executor
+        self._queues = {}
+        self._counts = {}
+        self._timers = {}
+        self._tasks = set()
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def __getattr__(self, name):
+        kernels = self.__dict__['coords'].kernels
+        if name in kernels:
+            return partial_convert(self, name)
+        raise AttributeError('{} has no vector conversion {}'.format(
+            type(self.__dict__['coords']).__name__, name))
+
+    async def convert(self, name, vec):
+        """queue vec for the named conversion and wait for its result"""
+        kernel = self.coords.kernels[name]
+        vec = np.asarray(vec)
+        if vec.shape[-1:] != (3,):
+            raise ValueError('expected (..., 3) positions, got shape {}'.format(vec.shape))
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._queues.setdefault(name, []).append((vec, future))
+            self._counts[name] = self._counts.get(name, 0) + vec.size//3
+            if self._counts[name] >= self.max_batch:
+                self._flush(name, kernel)
+            elif name not in self._timers:
+                self._timers[name] = loop.call_later(
+                    self.max_delay, self._flush, name, kernel)
+            return await future
+
+    def _flush(self, name, kernel):
+        """start converting everything queued for name"""
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        queue = self._queues.pop(name, [])
+        self._counts.pop(name, None)
+        for batch in self.batches(queue):
+            task = asyncio.ensure_future(self._run(kernel, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def batches(self, queue):
+        """split queued requests into batches of at most max_batch positions
+
+        A single request larger than max_batch forms a batch of its own.
+        """
+        batch, count = [], 0
+        for request in queue:
+            rows = request[0].size//3
+            if batch and count + rows > self.max_batch:
+                yield batch
+                batch, count = [], 0
+            batch.append(request)
+            count += rows
+        if batch:
+            yield batch
+
+    async def _run(self, kernel, queue):
+        """convert one batch off the event loop and deliver the results"""
+        rows = [vec.reshape((-1, 3)) for vec, _ in queue]
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, kernel, np.concatenate(rows))
+        except Exception as error:
+            for _, future in queue:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        start = 0
+        for (vec, future), block in zip(queue, rows):
+            if not future.done():
+                future.set_result(result[start:start + len(block)].reshape(vec.shape))
+            start += len(block)
+
+    async def aclose(self):
+        """convert everything still queued and wait for all batches to finish"""
+        for name in list(self._queues):
+            self._flush(name, self.coords.kernels[name])
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+def partial_convert(batcher, name):
+    async def convert(vec):
+        return await batcher.convert(name, vec)
+    convert.__name__ = name
+    return convert
+
+
+def test_conversion_batcher():
+    from kamodo_geometry.coordinates import Cartesian, Geographic
+    cartesian = Cartesian(hvec_order=['alt', 'lat', 'lon'])
+    geographic = Geographic()
+    xvec = np.random.RandomState(0).uniform(-1e7, 1e7, (200, 3))
+    expected = cartesian.hvec(xvec)
+    batches = []
+
+    def counting(kernel):
+        def convert(vec, out=None):
+            batches.append(len(vec))
+            return kernel(vec, out=out)
+        return convert
+
+    cartesian.kernels = dict(cartesian.kernels, hvec=counting(cartesian.kernels['hvec']))
+
+    async def main():
+        async with ConversionBatcher(cartesian, max_batch=64, max_delay=0.01,
+                                     max_pending=100) as cart:
+            results = await asyncio.gather(*[cart.hvec(_) for _ in xvec])
+            block = await cart.rvec(xvec[:10].reshape((2, 5, 3)))
+        async with ConversionBatcher(geographic) as geo:
+            hvec = await geo.xvec(results[0][::-1])
+        return results, block, hvec
+
+    results, block, hvec = asyncio.run(main())
+    assert np.allclose(results, expected)
+    assert max(batches) <= 64 and sum(batches) == len(xvec)
+    assert len(batches) < len(xvec)
+    assert block.shape == (2, 5, 3)
+    assert np.allclose(block, cartesian.rvec(xvec[:10]).reshape((2, 5, 3)))
+    assert np.allclose(hvec, xvec[0])
+
+    # flushed batches hold at most max_batch positions unless a request is larger
+    async def mixed():
+        async with ConversionBatcher(cartesian, max_batch=64, max_delay=0.01) as cart:
+            return await asyncio.gather(*([cart.hvec(_) for _ in xvec[:50]] +
+                                          [cart.hvec(xvec[:100])]))
+
+    batches.clear()
+    results = asyncio.run(mixed())
+    assert np.allclose(results[-1], expected[:100])
+    assert sorted(batches) == [50, 100]
+
+    async def failing():
+        async with ConversionBatcher(cartesian) as cart:
+            await cart.hvec(np.zeros((2, 2)))
+
+    try:
+        asyncio.run(failing())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('positions must have 3 components')
+
+
+def test_batcher_scaling():
+    """the cost of queueing a request does not grow with max_batch"""
+    import time
+    from kamodo_geometry.coordinates import Cartesian
+    cartesian = Cartesian()
+    xvec = np.random.RandomState(0).uniform(-1e7, 1e7, (8192, 3))
+
+    async def run(max_batch):
+        async with ConversionBatcher(cartesian, max_batch=max_batch, max_delay=0.01,
+                                     max_pending=len(xvec)) as cart:
+            t = time.perf_counter()
+            await asyncio.gather(*[cart.hvec(_) for _ in xvec])
+            return time.perf_counter() - t
+
+    small, large = [min(asyncio.run(run(max_batch)) for _ in range(3))
+                    for max_batch in (64, 4096)]
+    assert large < 2*small
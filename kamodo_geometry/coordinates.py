@@ -1,6 +1,17 @@
 from kamodo import Kamodo, kamodofy
+from collections import OrderedDict
+from functools import lru_cache, partial
+from operator import itemgetter
+import inspect
+import math
+import threading
+import types
+import weakref
 import numpy as np
 
+from kamodo_geometry.instrumentation import instrument
+from kamodo_geometry.lazy import lazy_attributes, constructs_kamodo
+
 
 def to_tuple(vec):
     """convert numpy vector into tuple shape"""
@@ -9,19 +20,763 @@ def to_tuple(vec):
     return vec
 
 
+# # Fused kernels
+#
+# Single-pass vector conversions shared by the classes below. Each kernel
+# computes its intermediates once and writes straight into one preallocated
+# (..., 3) output, placing components according to the requested order.
+# Floating point inputs keep their precision unless a dtype is requested.
+# A caller-supplied out must not overlap the input.
+
+def vec_dtype(components, dtype=None):
+    """output dtype for components: dtype if given, else their floating type"""
+    if dtype is not None:
+        return np.dtype(dtype)
+    dtype = np.result_type(*[np.asarray(_).dtype for _ in components])
+    if not np.issubdtype(dtype, np.floating):
+        return np.dtype(np.float64)
+    return dtype
+
+
+def empty_vec(*components, dtype=None, out=None):
+    """allocate a (..., 3) output matching the broadcast shape of components
+
+    If out is given, check its shape and return it instead.
+    """
+    shape = np.broadcast(*components).shape + (3,)
+    if out is None:
+        return np.empty(shape, dtype=vec_dtype(components, dtype))
+    if out.shape != shape:
+        raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+    return out
+
+
+def ordered_views(vec, names, order):
+    """views of the components of a (..., 3) vec laid out by order, listed by names"""
+    index = {name: i for i, name in enumerate(order)}
+    if sorted(index) != sorted(names):
+        raise NotImplementedError('order {} must be a permutation of {}'.format(order, names))
+    return [vec[..., index[name]] for name in names]
+
+
+def sph_to_cart(rvec, order=('x', 'y', 'z'), dtype=None, out=None):
+    """convert (r, theta, phi) to (x, y, z) arranged by order"""
+    r, theta, phi = to_tuple(rvec)
+    xvec = empty_vec(r, theta, phi, dtype=dtype, out=out)
+    x, y, z = ordered_views(xvec, ('x', 'y', 'z'), order)
+    rho = r*np.sin(theta)
+    np.multiply(rho, np.cos(phi), out=x)
+    np.multiply(rho, np.sin(phi), out=y)
+    np.multiply(r, np.cos(theta), out=z)
+    return xvec
+
+
+def sph_to_geo(rvec, order=('lon', 'lat', 'alt'), dtype=None, out=None):
+    """convert (r[m], theta[rad], phi[rad]) to (lon[deg], lat[deg], alt[m]) arranged by order"""
+    r, theta, phi = to_tuple(rvec)
+    hvec = empty_vec(r, theta, phi, dtype=dtype, out=out)
+    lon, lat, alt = ordered_views(hvec, ('lon', 'lat', 'alt'), order)
+    np.multiply(180/np.pi, phi, out=lon)
+    np.multiply(90, 1-2*theta/np.pi, out=lat)
+    np.subtract(r, 6371*1000, out=alt)
+    return hvec
+
+
+def cart_to_sph(xvec, order=('r', 'theta', 'phi'), phi_modulus=None,
+                dtype=None, out=None):
+    """convert (x, y, z) to (r, theta, phi) arranged by order"""
+    x, y, z = to_tuple(xvec)
+    rvec = empty_vec(x, y, z, dtype=dtype, out=out)
+    r, theta, phi = ordered_views(rvec, ('r', 'theta', 'phi'), order)
+    np.sqrt(x**2 + y**2 + z**2, out=r)
+    np.arccos(z/r, out=theta)
+    np.arctan2(y, x, out=phi)
+    if phi_modulus is not None:
+        np.mod(phi, phi_modulus, out=phi)
+    return rvec
+
+
+def cart_to_geo(xvec, order=('lon', 'lat', 'alt'), longitude_modulus=360,
+                dtype=None, out=None):
+    """convert (x[m], y[m], z[m]) to (lon[deg], lat[deg], alt[m]) arranged by order"""
+    x, y, z = to_tuple(xvec)
+    hvec = empty_vec(x, y, z, dtype=dtype, out=out)
+    lon, lat, alt = ordered_views(hvec, ('lon', 'lat', 'alt'), order)
+    r = np.sqrt(x**2 + y**2 + z**2)
+    np.subtract(r, 6371*1000, out=alt)
+    np.multiply(90, 1-2*np.arccos(z/r)/np.pi, out=lat)
+    np.multiply(180/np.pi, np.arctan2(y, x), out=lon)
+    np.mod(lon, longitude_modulus, out=lon)
+    return hvec
+
+
+def geo_to_sph(hvec, order=('r', 'theta', 'phi'), dtype=None, out=None):
+    """convert (lon[deg], lat[deg], alt[m]) to (r[m], theta[rad], phi[rad]) arranged by order"""
+    lon, lat, alt = to_tuple(hvec)
+    rvec = empty_vec(lon, lat, alt, dtype=dtype, out=out)
+    r, theta, phi = ordered_views(rvec, ('r', 'theta', 'phi'), order)
+    np.add(alt, 6371*1000, out=r)
+    np.multiply(1-lat/90, np.pi/2, out=theta)
+    np.multiply(lon, np.pi/180, out=phi)
+    return rvec
+
+
+def geo_to_cart(hvec, order=('x', 'y', 'z'), dtype=None, out=None):
+    """convert (lon[deg], lat[deg], alt[m]) to (x[m], y[m], z[m]) arranged by order"""
+    lon, lat, alt = to_tuple(hvec)
+    xvec = empty_vec(lon, lat, alt, dtype=dtype, out=out)
+    x, y, z = ordered_views(xvec, ('x', 'y', 'z'), order)
+    r = alt + 6371*1000
+    theta = (1-lat/90)*np.pi/2
+    phi = lon*np.pi/180
+    rho = r*np.sin(theta)
+    np.multiply(rho, np.cos(phi), out=x)
+    np.multiply(rho, np.sin(phi), out=y)
+    np.multiply(r, np.cos(theta), out=z)
+    return xvec
+
+
+def reorder(vec, names, order, dtype=None, out=None):
+    """copy the components of vec, listed by names, into a vector arranged by order"""
+    components = to_tuple(vec)
+    result = empty_vec(*components, dtype=dtype, out=out)
+    for view, component in zip(ordered_views(result, names, order), components):
+        view[...] = component
+    return result
+
+
+# # Ellipsoids
+#
+# With an ellipsoid, geographic coordinates are geodetic: lat is the angle
+# between the ellipsoid normal and the equatorial plane and alt is the height
+# above the ellipsoid along that normal. ECEF to geodetic uses the exact
+# closed form of Vermeille (2011), J. Geodesy 85:105-117, so no per-point
+# iteration is needed. In float64, positions round trip through
+# geodetic_to_ecef to within 1e-8 m for altitudes below 1000 km and to within
+# a relative 1e-15 of the geocentric distance beyond; latitudes agree to
+# 1e-13 deg. Points inside the ellipsoid's evolute (within ~43 km of the
+# geocenter) take the closed form's dedicated branches and round trip to the
+# same accuracy.
+
+ellipsoids = dict(
+    wgs84=(6378137.0, 1/298.257223563),
+    grs80=(6378137.0, 1/298.257222101),
+)
+
+
+def ellipsoid_parameters(ellipsoid):
+    """semi-major axis [m] and flattening of a named or (a, f) ellipsoid"""
+    if isinstance(ellipsoid, str):
+        if ellipsoid.lower() not in ellipsoids:
+            raise NotImplementedError('unknown ellipsoid: {}'.format(ellipsoid))
+        return ellipsoids[ellipsoid.lower()]
+    a, f = ellipsoid
+    return float(a), float(f)
+
+
+def geodetic_radii(lat, alt, ellipsoid='wgs84'):
+    """distance from the polar axis and height above the equator [m] of (lat[deg], alt[m])"""
+    a, f = ellipsoid_parameters(ellipsoid)
+    e2 = f*(2-f)
+    lat = np.multiply(lat, np.pi/180)
+    sin_lat = np.sin(lat)
+    n = a/np.sqrt(1 - e2*sin_lat**2)
+    return (n + alt)*np.cos(lat), (n*(1-e2) + alt)*sin_lat
+
+
+def geodetic_to_ecef(hvec, order=('x', 'y', 'z'), ellipsoid='wgs84', dtype=None, out=None):
+    """convert geodetic (lon[deg], lat[deg], alt[m]) to (x[m], y[m], z[m]) arranged by order"""
+    lon, lat, alt = to_tuple(hvec)
+    xvec = empty_vec(lon, lat, alt, dtype=dtype, out=out)
+    x, y, z = ordered_views(xvec, ('x', 'y', 'z'), order)
+    rho, z[...] = geodetic_radii(lat, alt, ellipsoid)
+    phi = np.multiply(lon, np.pi/180)
+    np.multiply(rho, np.cos(phi), out=x)
+    np.multiply(rho, np.sin(phi), out=y)
+    return xvec
+
+
+def ecef_to_geodetic(xvec, order=('lon', 'lat', 'alt'), ellipsoid='wgs84',
+                     longitude_modulus=360, dtype=None, out=None):
+    """convert (x[m], y[m], z[m]) to geodetic (lon[deg], lat[deg], alt[m]) arranged by order"""
+    x, y, z = to_tuple(xvec)
+    hvec = empty_vec(x, y, z, dtype=dtype, out=out)
+    lon, lat, alt = ordered_views(hvec, ('lon', 'lat', 'alt'), order)
+    a, f = ellipsoid_parameters(ellipsoid)
+    shape = hvec.shape[:-1]
+    x, y, z = [np.broadcast_to(_, shape) for _ in (x, y, z)]
+    # the closed form chains ~30 ufuncs, so intermediates are kept cache-sized
+    for rows in row_blocks(shape):
+        geodetic_block(x[rows], y[rows], z[rows], lon[rows], lat[rows], alt[rows], a, f)
+    if longitude_modulus is not None:
+        np.mod(lon, longitude_modulus, out=lon)
+    return hvec
+
+
+def row_blocks(shape, size=2**14):
+    """slices of the first axis of shape covering about size elements each"""
+    if len(shape) == 0:
+        return [Ellipsis]
+    rows = max(1, size // max(1, int(np.prod(shape[1:]))))
+    return [slice(start, start + rows) for start in range(0, shape[0], rows)]
+
+
+def geodetic_block(x, y, z, lon, lat, alt, a, f):
+    """write geodetic lon[deg], lat[deg], alt[m] of x, y, z[m] into the given views"""
+    e2 = f*(2-f)
+    e4 = e2*e2
+    rho = np.hypot(x, y)
+    p = (rho/a)**2
+    q = (1-e2)*(z/a)**2
+    r = (p + q - e4)/6
+    e4pq = e4*p*q
+    border = 8*r**3 + e4pq
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # outside the evolute, which holds for all points beyond ~43 km of the geocenter
+        rad = np.cbrt((np.sqrt(border) + np.sqrt(e4pq))**2)
+        u = r + rad/2 + 2*r**2/rad
+        inside = border <= 0
+        if inside.any():
+            u = np.array(u, ndmin=1)
+            r_, border_, e4pq_ = [np.broadcast_to(_, np.shape(u))[inside]
+                                  for _ in (r, border, e4pq)]
+            angle = 2*np.arctan2(np.sqrt(e4pq_), np.sqrt(-border_) + np.sqrt(-8*r_**3))/3
+            u[inside] = -4*r_*np.sin(angle)*np.cos(np.pi/6 + angle)
+            u = u.reshape(np.shape(r))
+        v = np.sqrt(u**2 + e4*q)
+        w = e2*(u + v - q)/(2*v)
+        k = (u + v)/(np.sqrt(w**2 + u + v) + w)
+        d = k*rho/(k + e2)
+        dz = np.hypot(d, z)
+        np.multiply((k + e2 - 1)/k, dz, out=alt)
+        np.multiply(360/np.pi, np.arctan2(z, dz + d), out=lat)
+
+    # the equatorial disc inside the evolute, where the closed form is singular
+    disc = inside & (q == 0)
+    if disc.any():
+        p_ = np.broadcast_to(p, disc.shape)[disc]
+        cos2 = p_*(1-e2)/(e2*(e2 - p_))
+        lat[disc] = 180/np.pi*np.arccos(np.sqrt(cos2))
+        alt[disc] = -a*(1-e2)/np.sqrt(1 - e2*(1 - cos2))
+
+    np.multiply(180/np.pi, np.arctan2(y, x), out=lon)
+
+
+def geodetic_to_sph(hvec, order=('r', 'theta', 'phi'), ellipsoid='wgs84', dtype=None, out=None):
+    """convert geodetic (lon[deg], lat[deg], alt[m]) to (r[m], theta[rad], phi[rad]) arranged by order"""
+    lon, lat, alt = to_tuple(hvec)
+    rvec = empty_vec(lon, lat, alt, dtype=dtype, out=out)
+    r, theta, phi = ordered_views(rvec, ('r', 'theta', 'phi'), order)
+    rho, z = geodetic_radii(lat, alt, ellipsoid)
+    np.hypot(rho, z, out=r)
+    np.arctan2(rho, z, out=theta)
+    np.multiply(lon, np.pi/180, out=phi)
+    return rvec
+
+
+def sph_to_geodetic(rvec, order=('lon', 'lat', 'alt'), ellipsoid='wgs84', dtype=None, out=None):
+    """convert (r[m], theta[rad], phi[rad]) to geodetic (lon[deg], lat[deg], alt[m]) arranged by order"""
+    hvec = ecef_to_geodetic(sph_to_cart(rvec, dtype=dtype), order, ellipsoid,
+                            longitude_modulus=None, dtype=dtype, out=out)
+    # longitude follows phi directly, as in sph_to_geo
+    lon = ordered_views(hvec, ('lon', 'lat', 'alt'), order)[0]
+    np.multiply(180/np.pi, to_tuple(rvec)[2], out=lon)
+    return hvec
+
+
+# # Transform chains
+#
+# Any two of the three coordinate systems are connected by a single fused
+# kernel. get_transform binds the kernel, its options and both component
+# orders once, so repeated calls skip all Kamodo dispatch.
+
+systems = dict(
+    spherical=('r', 'theta', 'phi'),
+    cartesian=('x', 'y', 'z'),
+    geographic=('lon', 'lat', 'alt'),
+)
+
+transform_kernels = {
+    ('spherical', 'cartesian'): sph_to_cart,
+    ('spherical', 'geographic'): sph_to_geo,
+    ('cartesian', 'spherical'): cart_to_sph,
+    ('cartesian', 'geographic'): cart_to_geo,
+    ('geographic', 'spherical'): geo_to_sph,
+    ('geographic', 'cartesian'): geo_to_cart,
+}
+
+
+ellipsoid_kernels = {
+    ('spherical', 'geographic'): sph_to_geodetic,
+    ('cartesian', 'geographic'): ecef_to_geodetic,
+    ('geographic', 'spherical'): geodetic_to_sph,
+    ('geographic', 'cartesian'): geodetic_to_ecef,
+}
+
+
+def ellipsoid_options(src, dst, options):
+    """drop the ellipsoid option where it does not apply and make it hashable"""
+    ellipsoid = options.pop('ellipsoid', None)
+    if ellipsoid is not None and (src, dst) in ellipsoid_kernels:
+        options['ellipsoid'] = ellipsoid if isinstance(ellipsoid, str) else tuple(ellipsoid)
+    return options
+
+
+def get_transform(src, dst, order=None, src_order=None, **options):
+    """fused callable converting (..., 3) vectors from system src to dst
+
+    src and dst are one of 'spherical', 'cartesian', 'geographic'. order and
+    src_order give the component layout of the output and input vectors,
+    defaulting to the layouts in systems. Remaining options (dtype,
+    phi_modulus, longitude_modulus, ellipsoid) are passed to the kernel.
+    Geographic coordinates are geodetic if an ellipsoid is given.
+
+    example:
+        >>> geo_to_sph = get_transform('geographic', 'spherical', order=['phi', 'theta', 'r'])
+        >>> rvec = geo_to_sph(hvec, out=rvec)
+    """
+    for system in (src, dst):
+        if system not in systems:
+            raise NotImplementedError('unknown coordinate system: {}'.format(system))
+    options = ellipsoid_options(src, dst, options)
+    order = tuple(order or systems[dst])
+    src_order = tuple(src_order or systems[src])
+    return build_transform(src, dst, order, src_order, tuple(sorted(options.items())))
+
+
+@lru_cache(maxsize=128)
+def build_transform(src, dst, order, src_order, options):
+    """build and cache the callable for get_transform"""
+    options = dict(options)
+    if src == dst:
+        kernel = partial(reorder, names=systems[dst], order=order, **options)
+    elif 'ellipsoid' in options:
+        kernel = partial(ellipsoid_kernels[src, dst], order=order, **options)
+    else:
+        kernel = partial(transform_kernels[src, dst], order=order, **options)
+
+    if src_order == systems[src]:
+        return kernel
+
+    # permute input components as views, so no reordered copy is made
+    permutation = [src_order.index(name) for name in systems[src]]
+
+    def transform(vec, out=None):
+        components = to_tuple(vec)
+        return kernel([components[i] for i in permutation], out=out)
+
+    return transform
+
+
+# # Scalar fast path
+#
+# Single positions given as plain floats skip Kamodo dispatch, unit handling
+# and array allocation entirely. These kernels evaluate the same expressions
+# as the fused kernels above with the math module and return tuples in the
+# default component order of each system.
+
+def scalar_acos(x):
+    """math.acos returning nan outside [-1, 1], like np.arccos"""
+    try:
+        return math.acos(x)
+    except ValueError:
+        return math.nan
+
+
+def scalar_div(a, b):
+    """a/b returning nan or inf for b == 0, like numpy division"""
+    try:
+        return a/b
+    except ZeroDivisionError:
+        return math.nan if a == 0 or a != a else math.copysign(math.inf, a)
+
+
+def sph_to_cart_scalar(rvec):
+    """convert a single (r, theta, phi) to an (x, y, z) tuple"""
+    r, theta, phi = rvec
+    rho = r*math.sin(theta)
+    return rho*math.cos(phi), rho*math.sin(phi), r*math.cos(theta)
+
+
+def sph_to_geo_scalar(rvec):
+    """convert a single (r[m], theta[rad], phi[rad]) to a (lon[deg], lat[deg], alt[m]) tuple"""
+    r, theta, phi = rvec
+    return 180/math.pi*phi, 90*(1-2*theta/math.pi), r-6371*1000
+
+
+def cart_to_sph_scalar(xvec, phi_modulus=None):
+    """convert a single (x, y, z) to an (r, theta, phi) tuple"""
+    x, y, z = xvec
+    r = math.sqrt(x**2 + y**2 + z**2)
+    phi = math.atan2(y, x)
+    if phi_modulus is not None:
+        phi = phi % phi_modulus
+    return r, scalar_acos(scalar_div(z, r)), phi
+
+
+def cart_to_geo_scalar(xvec, longitude_modulus=360):
+    """convert a single (x[m], y[m], z[m]) to a (lon[deg], lat[deg], alt[m]) tuple"""
+    x, y, z = xvec
+    r = math.sqrt(x**2 + y**2 + z**2)
+    lat = 90*(1-2*scalar_acos(scalar_div(z, r))/math.pi)
+    return (180/math.pi*math.atan2(y, x)) % longitude_modulus, lat, r-6371*1000
+
+
+def geo_to_sph_scalar(hvec):
+    """convert a single (lon[deg], lat[deg], alt[m]) to an (r[m], theta[rad], phi[rad]) tuple"""
+    lon, lat, alt = hvec
+    return alt+6371*1000, (1-lat/90)*(math.pi/2), lon*(math.pi/180)
+
+
+def geo_to_cart_scalar(hvec):
+    """convert a single (lon[deg], lat[deg], alt[m]) to an (x[m], y[m], z[m]) tuple"""
+    lon, lat, alt = hvec
+    r = alt + 6371*1000
+    theta = (1-lat/90)*math.pi/2
+    phi = lon*math.pi/180
+    rho = r*math.sin(theta)
+    return rho*math.cos(phi), rho*math.sin(phi), r*math.cos(theta)
+
+
+def geodetic_radii_scalar(lat, alt, ellipsoid='wgs84'):
+    """distance from the polar axis and height above the equator [m] of a single (lat, alt)"""
+    a, f = ellipsoid_parameters(ellipsoid)
+    e2 = f*(2-f)
+    lat = lat*(math.pi/180)
+    sin_lat = math.sin(lat)
+    n = a/math.sqrt(1 - e2*sin_lat**2)
+    return (n + alt)*math.cos(lat), (n*(1-e2) + alt)*sin_lat
+
+
+def geodetic_to_ecef_scalar(hvec, ellipsoid='wgs84'):
+    """convert a single geodetic (lon[deg], lat[deg], alt[m]) to an (x[m], y[m], z[m]) tuple"""
+    lon, lat, alt = hvec
+    rho, z = geodetic_radii_scalar(lat, alt, ellipsoid)
+    phi = lon*(math.pi/180)
+    return rho*math.cos(phi), rho*math.sin(phi), z
+
+
+def ecef_to_geodetic_scalar(xvec, ellipsoid='wgs84', longitude_modulus=360):
+    """convert a single (x[m], y[m], z[m]) to a geodetic (lon[deg], lat[deg], alt[m]) tuple"""
+    x, y, z = xvec
+    a, f = ellipsoid_parameters(ellipsoid)
+    e2 = f*(2-f)
+    e4 = e2*e2
+    lon = 180/math.pi*math.atan2(y, x)
+    if longitude_modulus is not None:
+        lon = lon % longitude_modulus
+
+    rho = math.hypot(x, y)
+    p = (rho/a)**2
+    q = (1-e2)*(z/a)**2
+    r = (p + q - e4)/6
+    e4pq = e4*p*q
+    border = 8*r**3 + e4pq
+    if border > 0:
+        rad = ((math.sqrt(border) + math.sqrt(e4pq))**2)**(1/3)
+        u = r + rad/2 + 2*r**2/rad
+    elif q != 0:
+        angle = 2*math.atan2(math.sqrt(e4pq), math.sqrt(-border) + math.sqrt(-8*r**3))/3
+        u = -4*r*math.sin(angle)*math.cos(math.pi/6 + angle)
+    else:
+        cos2 = p*(1-e2)/(e2*(e2 - p))
+        return (lon, 180/math.pi*math.acos(math.sqrt(cos2)),
+                -a*(1-e2)/math.sqrt(1 - e2*(1 - cos2)))
+    v = math.sqrt(u**2 + e4*q)
+    w = e2*(u + v - q)/(2*v)
+    k = (u + v)/(math.sqrt(w**2 + u + v) + w)
+    d = k*rho/(k + e2)
+    dz = math.hypot(d, z)
+    return lon, 360/math.pi*math.atan2(z, dz + d), (k + e2 - 1)/k*dz
+
+
+def geodetic_to_sph_scalar(hvec, ellipsoid='wgs84'):
+    """convert a single geodetic (lon[deg], lat[deg], alt[m]) to an (r[m], theta[rad], phi[rad]) tuple"""
+    lon, lat, alt = hvec
+    rho, z = geodetic_radii_scalar(lat, alt, ellipsoid)
+    return math.hypot(rho, z), math.atan2(rho, z), lon*(math.pi/180)
+
+
+def sph_to_geodetic_scalar(rvec, ellipsoid='wgs84'):
+    """convert a single (r[m], theta[rad], phi[rad]) to a geodetic (lon[deg], lat[deg], alt[m]) tuple"""
+    _, lat, alt = ecef_to_geodetic_scalar(sph_to_cart_scalar(rvec), ellipsoid, None)
+    return 180/math.pi*rvec[2], lat, alt
+
+
+scalar_kernels = {
+    ('spherical', 'cartesian'): sph_to_cart_scalar,
+    ('spherical', 'geographic'): sph_to_geo_scalar,
+    ('cartesian', 'spherical'): cart_to_sph_scalar,
+    ('cartesian', 'geographic'): cart_to_geo_scalar,
+    ('geographic', 'spherical'): geo_to_sph_scalar,
+    ('geographic', 'cartesian'): geo_to_cart_scalar,
+}
+
+scalar_ellipsoid_kernels = {
+    ('spherical', 'geographic'): sph_to_geodetic_scalar,
+    ('cartesian', 'geographic'): ecef_to_geodetic_scalar,
+    ('geographic', 'spherical'): geodetic_to_sph_scalar,
+    ('geographic', 'cartesian'): geodetic_to_ecef_scalar,
+}
+
+
+def get_scalar_transform(src, dst, order=None, src_order=None, **options):
+    """callable converting one position, a sequence of 3 floats, from src to dst
+
+    Takes the same arguments as get_transform and returns a tuple of floats.
+    The dtype option does not apply and is ignored.
+
+    example:
+        >>> to_hvec = get_scalar_transform('cartesian', 'geographic')
+        >>> lon, lat, alt = to_hvec((x, y, z))
+    """
+    for system in (src, dst):
+        if system not in systems:
+            raise NotImplementedError('unknown coordinate system: {}'.format(system))
+    options.pop('dtype', None)
+    options = ellipsoid_options(src, dst, options)
+    order = tuple(order or systems[dst])
+    src_order = tuple(src_order or systems[src])
+    return build_scalar_transform(src, dst, order, src_order, tuple(sorted(options.items())))
+
+
+@lru_cache(maxsize=128)
+def build_scalar_transform(src, dst, order, src_order, options):
+    """build and cache the callable for get_scalar_transform"""
+    kernels = scalar_ellipsoid_kernels if 'ellipsoid' in dict(options) else scalar_kernels
+    if src == dst:
+        kernel = tuple
+    elif options:
+        kernel = partial(kernels[src, dst], **dict(options))
+    else:
+        kernel = kernels[src, dst]
+
+    if src_order != systems[src]:
+        permute_input = itemgetter(*[src_order.index(name) for name in systems[src]])
+        inner = kernel
+        kernel = lambda vec: inner(permute_input(vec))
+    if order != systems[dst]:
+        permute_output = itemgetter(*[systems[dst].index(name) for name in order])
+        outer = kernel
+        kernel = lambda vec: permute_output(outer(vec))
+    return kernel
+
+
+class ScalarConversions(object):
+    """namespace of the scalar conversions of a coordinate object
+
+    example:
+        >>> lon, lat, alt = Cartesian().scalar.hvec((x, y, z))
+    """
+    def __init__(self, **conversions):
+        self.__dict__.update(conversions)
+
+    def __repr__(self):
+        return 'ScalarConversions({})'.format(', '.join(sorted(self.__dict__)))
+
+
+# # Expression cache
+#
+# Kamodo parses, unit-checks and lambdifies every registration, which makes
+# constructing the classes below expensive. Identically configured instances
+# produce identical registrations, so each one is compiled once per process
+# and copied into later instances.
+
+class ExpressionCache(object):
+    """bounded, process-wide LRU cache of compiled Kamodo registrations
+
+    keys are (class name, constructor options, symbol, expression)
+    """
+    def __init__(self, maxsize=512):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """retrieve a compiled entry, or None if it is not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """store a compiled entry, evicting the least recently used"""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        """remove all entries and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """cache statistics as a dictionary"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        maxsize=self._maxsize, currsize=len(self._entries))
+
+
+expression_cache = ExpressionCache()
+
+
+def expression_key(expr):
+    """hashable identity of a registered expression, or None"""
+    if isinstance(expr, str):
+        return expr
+    return getattr(expr, '__qualname__', None)
+
+
+def ellipsoid_key(ellipsoid):
+    """hashable identity of an ellipsoid option"""
+    if ellipsoid is None:
+        return None
+    return ellipsoid_parameters(ellipsoid)
+
+
+def dtype_key(dtype):
+    """hashable identity of a dtype option"""
+    if dtype is None:
+        return None
+    return np.dtype(dtype).str
+
+
+def latex_repr(kamodo, key):
+    """_repr_latex_ of the function registered under key, not keeping kamodo alive"""
+    ref = weakref.ref(kamodo)
+    name = str(key if isinstance(key, type) else type(key))
+    return lambda: ref().func_latex(name, mode='inline')
+
+
+def copy_function(func, kamodo, key):
+    """shallow copy of a registered function, rendering its latex from kamodo"""
+    if not inspect.isfunction(func):
+        return func
+    copy = types.FunctionType(func.__code__, func.__globals__, func.__name__,
+                              func.__defaults__, func.__closure__)
+    copy.__kwdefaults__ = func.__kwdefaults__
+    copy.__dict__.update(func.__dict__)
+    copy._repr_latex_ = latex_repr(kamodo, key)
+    return copy
+
+
+class CachedKamodo(Kamodo):
+    """Kamodo whose construction-time registrations go through expression_cache
+
+    Subclasses set _cache_options to a hashable tuple of their constructor
+    options while registering. Compiled expressions and the signatures of
+    registered functions are shared between instances with the same
+    options; registered functions themselves stay with their instance.
+    Registered functions are instrumented as 'ClassName.function'.
+    """
+    _cache_options = None
+    _registries = ('data', 'signatures', 'symbol_registry', 'unit_registry')
+
+    def __setitem__(self, sym_name, input_expr):
+        expr_key = expression_key(input_expr)
+        if self._cache_options is None or expr_key is None:
+            before = dict(self.data)
+            super(CachedKamodo, self).__setitem__(sym_name, input_expr)
+            return self._instrument(before)
+
+        key = (type(self).__name__, self._cache_options, sym_name, expr_key)
+        entry = expression_cache.get(key)
+        if entry is None:
+            before = {name: dict(getattr(self, name)) for name in self._registries}
+            super(CachedKamodo, self).__setitem__(sym_name, input_expr)
+            new = [(k, v) for k, v in self.data.items() if before['data'].get(k) is not v]
+            for k, func in new:
+                if inspect.isfunction(func):
+                    func._repr_latex_ = latex_repr(self, k)
+            # registered functions are often closures over self, so only
+            # the keys they are stored under are cached, not the functions
+            entry = {name: [(k, v) for k, v in getattr(self, name).items()
+                            if before[name].get(k) is not v]
+                     for name in self._registries}
+            entry['data'] = [(k, v) for k, v in new if v is not input_expr]
+            entry['bound'] = [k for k, v in new if v is input_expr]
+            expression_cache.put(key, entry)
+            self._instrument(before['data'])
+        else:
+            for name in self._registries[1:]:
+                getattr(self, name).update(entry[name])
+            # each instance gets its own copy of the compiled functions
+            before = dict(self.data)
+            copies = {}
+            for k, func in entry['data']:
+                if id(func) not in copies:
+                    copies[id(func)] = copy_function(func, self, k)
+                self.data[k] = copies[id(func)]
+            for k in entry['bound']:
+                input_expr._repr_latex_ = latex_repr(self, k)
+                self.data[k] = input_expr
+            self._instrument(before)
+
+    def _instrument(self, before):
+        """wrap functions registered since before for kamodo_geometry.instrumentation"""
+        wrapped = {}
+        for key, func in list(self.data.items()):
+            if before.get(key) is func or not inspect.isfunction(func):
+                continue
+            if id(func) not in wrapped:
+                name = '{}.{}'.format(type(self).__name__, str(key).split('(')[0])
+                wrapped[id(func)] = instrument(func, name)
+            self.data[key] = wrapped[id(func)]
+
+
 # # Spherical
 #
 # Conversions from spherical into geo, cartesian
 
-class Spherical(Kamodo):
-    def __init__(self, **kwargs):
+class Spherical(CachedKamodo):
+    def __init__(self, dtype=None, **kwargs):
+        self.dtype = dtype
+
+        # fused vector conversions accepting out=, keyed by output vector.
+        # dtype=None keeps the precision of floating point inputs
+        self.kernels = dict(xvec=get_transform('spherical', 'cartesian', dtype=dtype),
+                            hvec=get_transform('spherical', 'geographic', dtype=dtype))
+
+        # single positions as plain floats, returning tuples
+        self.scalar = ScalarConversions(
+            xvec=get_scalar_transform('spherical', 'cartesian'),
+            hvec=get_scalar_transform('spherical', 'geographic'))
+
         super(Spherical, self).__init__(**kwargs)
         
+        if not kwargs:
+            self._cache_options = (dtype_key(dtype),)
+
         self.register_cartesian()
         
         self.register_geographic()
         
         self['rvec'] = lambda r, theta, phi: np.stack((r, theta, phi), axis=-1)
+
+        self._cache_options = None
         
     def register_cartesian(self):
         """register conversions from spherical to cartesian"""
@@ -45,14 +800,10 @@ class Spherical(Kamodo):
         
         self['z'] = z_sph
         
-        @kamodofy
-        def xvec_sph(rvec):
+        @kamodofy(hidden_args=['out'])
+        def xvec_sph(rvec, out=None):
             """convert from (r,theta,phi) to (x,y,z)"""
-            r, theta, phi = to_tuple(rvec)
-            x = self.x(r, theta, phi)
-            y = self.y(r,theta, phi)
-            z = self.z(r, theta)
-            return np.stack((x, y, z), axis=-1)
+            return self.kernels['xvec'](rvec, out=out)
         
         self['xvec'] = xvec_sph
     
@@ -77,22 +828,20 @@ class Spherical(Kamodo):
         
         self['alt(r[m])[m]'] = 'r-6371*1000'
         
-        @kamodofy
-        def hvec_sph(rvec):
+        @kamodofy(hidden_args=['out'])
+        def hvec_sph(rvec, out=None):
             """convert from (r[m], theta[rad], phi[rad]) to (lon[deg], lat[deg], alt[m])"""
-            r, theta, phi = to_tuple(rvec)
-            lat = self.lat(theta)
-            lon = self.lon(phi)
-            alt = self.alt(r)
-            return np.stack((lon, lat, alt), axis=-1)
+            return self.kernels['hvec'](rvec, out=out)
         
         self['hvec'] = hvec_sph
 
 
 # need to test vectorization
 
-spherical = Spherical()
-spherical
+# Constructing a Kamodo object parses every registered expression with sympy,
+# so the module-level instance is only built on first access.
+
+__getattr__ = lazy_attributes(__name__, spherical=Spherical)
 
 
 # +
@@ -122,25 +871,54 @@ def test_spherical():
 #
 # From cartesian to spherical, geo
 
-class Cartesian(Kamodo):
+class Cartesian(CachedKamodo):
     def __init__(self,
         longitude_modulus = 360,
         phi_modulus = None,
         rvec_order = ['r', 'theta', 'phi'],
         hvec_order = ['lon', 'lat', 'alt'],
+        dtype = None,
+        ellipsoid = None,
         **kwargs):
         
         self.longitude_modulus = longitude_modulus
         self.phi_modulus = phi_modulus
         self._rvec_order = rvec_order
         self._hvec_order = hvec_order
+        self.dtype = dtype
+        # an ellipsoid such as 'wgs84' makes hvec geodetic, None keeps a spherical earth
+        self.ellipsoid = ellipsoid
+
+        # fused vector conversions accepting out=, keyed by output vector.
+        # dtype=None keeps the precision of floating point inputs
+        self.kernels = dict(
+            rvec=get_transform('cartesian', 'spherical', order=rvec_order,
+                               phi_modulus=phi_modulus, dtype=dtype),
+            hvec=get_transform('cartesian', 'geographic', order=hvec_order,
+                               longitude_modulus=longitude_modulus, dtype=dtype,
+                               ellipsoid=ellipsoid))
+
+        # single positions as plain floats, returning tuples
+        self.scalar = ScalarConversions(
+            rvec=get_scalar_transform('cartesian', 'spherical', order=rvec_order,
+                                      phi_modulus=phi_modulus),
+            hvec=get_scalar_transform('cartesian', 'geographic', order=hvec_order,
+                                      longitude_modulus=longitude_modulus,
+                                      ellipsoid=ellipsoid))
 
         super(Cartesian, self).__init__(**kwargs)
-        
+
+        if not kwargs:
+            self._cache_options = (longitude_modulus, phi_modulus,
+                                   tuple(rvec_order), tuple(hvec_order),
+                                   dtype_key(dtype), ellipsoid_key(ellipsoid))
+
         self.register_spherical()
         self.register_geographic()
         
         self['xvec'] = lambda x, y, z: np.stack((x, y, z), axis=-1)
+
+        self._cache_options = None
         
     def register_spherical(self):
         self['r'] = 'sqrt(x_**2 + y_**2 + z_**2)'
@@ -150,16 +928,10 @@ class Cartesian(Kamodo):
         else:
             self['phi'] = 'mod(atan2(y_, x_),{})'.format(self.phi_modulus)
         
-        @kamodofy
-        def rvec_cart(xvec):
+        @kamodofy(hidden_args=['out'])
+        def rvec_cart(xvec, out=None):
             """convert from x,y,z to r, theta, phi"""
-            x, y, z = to_tuple(xvec)
-            r = self.r(x,y,z)
-            theta = self.theta(x,y,z)
-            phi = self.phi(x,y)
-            coord_dict = dict(r=r, theta=theta, phi=phi)
-            rvec = [coord_dict[_] for _ in self._rvec_order]
-            return np.stack(rvec, axis=-1)
+            return self.kernels['rvec'](xvec, out=out)
         
         self['rvec'] = rvec_cart
     
@@ -171,7 +943,22 @@ class Cartesian(Kamodo):
             return (180*phi/np.pi)%self.longitude_modulus
 
         self['lon'] = lon_cart
-        
+
+        if self.ellipsoid is None:
+            self.register_spherical_earth()
+        else:
+            self.register_geodetic()
+
+        @kamodofy(arg_units=dict(xvec='m'), hidden_args=['out'])
+        def hvec_cart(xvec, out=None):
+            """convert from [x[m],y[m],z[m]] to [lon[deg], lat[deg], alt[m]]"""
+            return self.kernels['hvec'](xvec, out=out)
+
+        self['hvec'] = hvec_cart
+
+    def register_spherical_earth(self):
+        """register latitude and altitude above a spherical earth"""
+
         @kamodofy(units='deg', arg_units=dict(theta='rad'),
           equation='90(1-2 acos(z/\\sqrt{x^2+y^2+z^2}) /\\pi)')
         def lat_cart(x, y, z):
@@ -188,19 +975,23 @@ class Cartesian(Kamodo):
             return r - 6371*1000
 
         self['alt'] = alt_cart
-        
-        @kamodofy(arg_units=dict(xvec='m'))
-        def hvec_cart(xvec):
-            """convert from [x[m],y[m],z[m]] to [lon[deg], lat[deg], alt[m]]"""
-            x, y, z = to_tuple(xvec)
-            alt = self.alt(x,y,z)
-            lat = self.lat(x,y,z)
-            lon = self.lon(x,y)
-            coord_dict = dict(lon=lon, lat=lat, alt=alt)
-            hvec = [coord_dict[_] for _ in self._hvec_order]
-            return np.stack(hvec, axis=-1)
 
-        self['hvec'] = hvec_cart
+    def register_geodetic(self):
+        """register geodetic latitude and altitude above self.ellipsoid"""
+
+        @kamodofy(units='deg', arg_units=dict(x='m', y='m', z='m'))
+        def lat_cart(x, y, z):
+            """Geodetic latitude"""
+            return ecef_to_geodetic((x, y, z), ellipsoid=self.ellipsoid)[..., 1]
+
+        self['lat'] = lat_cart
+
+        @kamodofy(units='m', arg_units=dict(x='m', y='m', z='m'))
+        def alt_cart(x, y, z):
+            """Height above the ellipsoid"""
+            return ecef_to_geodetic((x, y, z), ellipsoid=self.ellipsoid)[..., 2]
+
+        self['alt'] = alt_cart
 
 
 # +
@@ -226,15 +1017,37 @@ def test_cartesian():
 # ## Geographic
 # Convert from geographic (lon, lat, alt) to Cartesian, spherical
 
-class Geographic(Kamodo):
-    def __init__(self, **kwargs):
-        
+class Geographic(CachedKamodo):
+    def __init__(self, dtype=None, ellipsoid=None, **kwargs):
+        self.dtype = dtype
+        # an ellipsoid such as 'wgs84' makes lat, alt geodetic, None keeps a spherical earth
+        self.ellipsoid = ellipsoid
+
+        # fused vector conversions accepting out=, keyed by output vector.
+        # dtype=None keeps the precision of floating point inputs
+        self.kernels = dict(
+            rvec=get_transform('geographic', 'spherical', dtype=dtype, ellipsoid=ellipsoid),
+            xvec=get_transform('geographic', 'cartesian', dtype=dtype, ellipsoid=ellipsoid))
+
+        # single positions as plain floats, returning tuples
+        self.scalar = ScalarConversions(
+            rvec=get_scalar_transform('geographic', 'spherical', ellipsoid=ellipsoid),
+            xvec=get_scalar_transform('geographic', 'cartesian', ellipsoid=ellipsoid))
+
         super(Geographic, self).__init__(**kwargs)
 
-        self.register_spherical()
-        self.register_cartesian()
+        if not kwargs:
+            self._cache_options = (dtype_key(dtype), ellipsoid_key(ellipsoid))
+
+        if ellipsoid is None:
+            self.register_spherical()
+            self.register_cartesian()
+        else:
+            self.register_geodetic()
         self['hvec'] = lambda lon, lat, alt: np.stack((lon, lat, alt), axis=-1)
 
+        self._cache_options = None
+
     def register_spherical(self):
         """convert from geographic to spherical"""
 
@@ -254,14 +1067,10 @@ class Geographic(Kamodo):
 
         self['phi'] = phi_geo
 
-        @kamodofy
-        def rvec_geo(hvec):
+        @kamodofy(hidden_args=['out'])
+        def rvec_geo(hvec, out=None):
             """convert from (lon[deg], lat[deg], alt[m]) to (r, theta, phi)"""
-            lon, lat, alt = to_tuple(hvec)
-            r = self.r(alt)
-            theta = self.theta(lat)
-            phi = self.phi(lon)
-            return np.stack((r, theta, phi), axis=-1)
+            return self.kernels['rvec'](hvec, out=out)
 
         self['rvec'] = rvec_geo
 
@@ -276,14 +1085,64 @@ class Geographic(Kamodo):
         self['z'] = 'r*cos(theta)'
 
 
-        @kamodofy
-        def xvec_geo(hvec):
+        @kamodofy(hidden_args=['out'])
+        def xvec_geo(hvec, out=None):
             """convert from (lon[deg], lat[deg], alt[m]) to (x, y, z)"""
-            lon, lat, alt = to_tuple(hvec)
-            x = self.x(alt, lat, lon)
-            y = self.y(alt, lat, lon)
-            z = self.z(alt, lat)
-            return np.stack((x,y,z), axis=-1)
+            return self.kernels['xvec'](hvec, out=out)
+
+        self['xvec'] = xvec_geo
+
+    def register_geodetic(self):
+        """convert from geodetic coordinates on self.ellipsoid to spherical and cartesian"""
+
+        @kamodofy(units='m', arg_units=dict(lat='deg', alt='m'))
+        def r_geo(lat, alt):
+            return np.hypot(*geodetic_radii(lat, alt, self.ellipsoid))
+
+        self['r'] = r_geo
+
+        @kamodofy(units='rad', arg_units=dict(lat='deg', alt='m'))
+        def theta_geo(lat, alt):
+            return np.arctan2(*geodetic_radii(lat, alt, self.ellipsoid))
+
+        self['theta'] = theta_geo
+
+        @kamodofy(units='rad', arg_units=dict(lon='deg'),
+                 equation='\\pi lon/180')
+        def phi_geo(lon):
+            return lon*np.pi/180
+
+        self['phi'] = phi_geo
+
+        @kamodofy(units='m', arg_units=dict(lon='deg', lat='deg', alt='m'))
+        def x_geo(lon, lat, alt):
+            return geodetic_radii(lat, alt, self.ellipsoid)[0]*np.cos(lon*np.pi/180)
+
+        self['x'] = x_geo
+
+        @kamodofy(units='m', arg_units=dict(lon='deg', lat='deg', alt='m'))
+        def y_geo(lon, lat, alt):
+            return geodetic_radii(lat, alt, self.ellipsoid)[0]*np.sin(lon*np.pi/180)
+
+        self['y'] = y_geo
+
+        @kamodofy(units='m', arg_units=dict(lat='deg', alt='m'))
+        def z_geo(lat, alt):
+            return geodetic_radii(lat, alt, self.ellipsoid)[1]
+
+        self['z'] = z_geo
+
+        @kamodofy(hidden_args=['out'])
+        def rvec_geo(hvec, out=None):
+            """convert from geodetic (lon[deg], lat[deg], alt[m]) to (r, theta, phi)"""
+            return self.kernels['rvec'](hvec, out=out)
+
+        self['rvec'] = rvec_geo
+
+        @kamodofy(hidden_args=['out'])
+        def xvec_geo(hvec, out=None):
+            """convert from geodetic (lon[deg], lat[deg], alt[m]) to (x, y, z)"""
+            return self.kernels['xvec'](hvec, out=out)
 
         self['xvec'] = xvec_geo
 
@@ -306,3 +1165,249 @@ def test_geographic():
 
 
 
+
+def test_fused_kernels():
+    spherical = Spherical()
+    cartesian = Cartesian(phi_modulus=2*np.pi, rvec_order=['phi', 'r', 'theta'],
+                          hvec_order=['alt', 'lon', 'lat'])
+    geographic = Geographic()
+
+    r = np.linspace(1, 2, 20).reshape((4,5))
+    theta = np.linspace(0.1, np.pi-0.1, 20).reshape((4,5))
+    phi = np.linspace(-np.pi, np.pi, 20).reshape((4,5))
+    rvec = spherical.rvec(r, theta, phi)
+
+    expected = np.stack((spherical.x(r, theta, phi),
+                         spherical.y(r, theta, phi),
+                         spherical.z(r, theta)), axis=-1)
+    assert np.allclose(spherical.xvec(rvec), expected)
+    expected = np.stack((spherical.lon(phi),
+                         spherical.lat(theta),
+                         spherical.alt(r)), axis=-1)
+    assert np.allclose(spherical.hvec(rvec), expected)
+
+    x, y, z = np.linspace(-1, 1, 60).reshape((3,4,5))
+    xvec = cartesian.xvec(x, y, z)
+    expected = np.stack((cartesian.phi(x_=x, y_=y),
+                         cartesian.r(x_=x, y_=y, z_=z),
+                         cartesian.theta(x_=x, y_=y, z_=z)), axis=-1)
+    assert np.allclose(cartesian.rvec(xvec), expected)
+    expected = np.stack((cartesian.alt(x, y, z),
+                         cartesian.lon(x, y),
+                         cartesian.lat(x, y, z)), axis=-1)
+    assert np.allclose(cartesian.hvec(xvec), expected)
+
+    lon = np.linspace(-180, 180, 20).reshape((4,5))
+    lat = np.linspace(-90, 90, 20).reshape((4,5))
+    alt = np.linspace(0, 100, 20).reshape((4,5))
+    hvec = geographic.hvec(lon, lat, alt)
+    expected = np.stack((geographic.r(alt=alt),
+                         geographic.theta(lat),
+                         geographic.phi(lon)), axis=-1)
+    assert np.allclose(geographic.rvec(hvec), expected)
+    expected = np.stack((geographic.x(alt=alt, lat=lat, lon=lon),
+                         geographic.y(alt=alt, lat=lat, lon=lon),
+                         geographic.z(alt=alt, lat=lat)), axis=-1)
+    assert np.allclose(geographic.xvec(hvec), expected)
+
+    # tuples of components broadcast like arrays
+    assert cartesian.rvec((x, y, 0)).shape == (4, 5, 3)
+
+def test_import_budget():
+    """importing the module must not construct any Kamodo objects"""
+    assert not constructs_kamodo('kamodo_geometry.coordinates')
+
+    from kamodo_geometry import coordinates
+    assert isinstance(coordinates.spherical, Spherical)
+    assert coordinates.spherical is coordinates.spherical
+
+def test_expression_cache():
+    expression_cache.clear()
+    first = Cartesian(longitude_modulus=180, rvec_order=['phi', 'theta', 'r'])
+    misses = expression_cache.info()['misses']
+    second = Cartesian(longitude_modulus=180, rvec_order=['phi', 'theta', 'r'])
+    info = expression_cache.info()
+    assert info['misses'] == misses
+    assert info['hits'] == misses
+    assert list(first.keys()) == list(second.keys())
+    assert np.allclose(first.rvec((1, 1, 0)), second.rvec((1, 1, 0)))
+    assert np.allclose(second.lon(-1, 0), 0)
+
+    # different options compile new entries
+    Cartesian(longitude_modulus=360, rvec_order=['phi', 'theta', 'r'])
+    assert expression_cache.info()['misses'] > misses
+
+    # registrations made after construction are not cached
+    second['f'] = 'r**2'
+    assert len(second) == len(first) + 2
+
+    expression_cache.maxsize = 4
+    assert expression_cache.info()['currsize'] == 4
+    expression_cache.maxsize = 512
+
+
+def test_expression_cache_instances():
+    """cache hits must not share functions bound to another instance"""
+    import gc, weakref
+    expression_cache.clear()
+    first = Cartesian()
+    second = Cartesian()
+    xvec = np.array([[1., 1., 0.]])
+    second.kernels['rvec'] = lambda xvec, out=None: np.zeros_like(xvec)
+    assert np.allclose(second.rvec(xvec), 0)
+    assert not np.allclose(first.rvec(xvec), 0)
+    assert expression_cache.info()['hits'] > 0
+
+    ref = weakref.ref(first)
+    del first
+    gc.collect()
+    assert ref() is None
+
+def test_dtype_and_out():
+    xvec = np.random.RandomState(0).uniform(-1e7, 1e7, (10, 3)).astype(np.float32)
+    cartesian = Cartesian()
+    for func in (cartesian.rvec, cartesian.hvec):
+        assert func(xvec).dtype == np.float32
+        assert np.allclose(func(xvec), func(xvec.astype(np.float64)), rtol=1e-5)
+    assert cartesian.rvec((1, 0, 0)).dtype == np.float64
+
+    cartesian = Cartesian(dtype=np.float32)
+    assert cartesian.rvec(xvec.astype(np.float64)).dtype == np.float32
+
+    spherical = Spherical()
+    geographic = Geographic()
+    rvec = cartesian.rvec(xvec)
+    hvec = spherical.hvec(rvec)
+    for func, vec in ((spherical.xvec, rvec), (spherical.hvec, rvec),
+                      (geographic.xvec, hvec), (geographic.rvec, hvec)):
+        out = np.empty_like(vec)
+        assert func(vec, out=out) is out
+        assert out.dtype == np.float32
+        assert np.allclose(out, func(vec))
+
+    try:
+        spherical.xvec(rvec, out=np.empty((3, 3)))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('mismatched out should raise')
+
+def test_get_transform():
+    hvec = np.stack(np.meshgrid(np.linspace(-180, 180, 7),
+                                np.linspace(-80, 80, 5),
+                                [0, 1000]), axis=-1)
+    xvec = Geographic().xvec(hvec)
+    rvec = Cartesian().rvec(xvec)
+
+    assert np.allclose(get_transform('geographic', 'cartesian')(hvec), xvec)
+    assert np.allclose(get_transform('cartesian', 'spherical')(xvec), rvec)
+    assert np.allclose(get_transform('spherical', 'geographic')(rvec), hvec)
+    assert np.allclose(get_transform('geographic', 'spherical')(hvec), rvec)
+
+    # output and input layouts
+    to_rvec = get_transform('geographic', 'spherical', order=['phi', 'theta', 'r'])
+    assert np.allclose(to_rvec(hvec), rvec[..., ::-1])
+    from_rvec = get_transform('spherical', 'cartesian', src_order=['phi', 'theta', 'r'])
+    assert np.allclose(from_rvec(rvec[..., ::-1]), xvec)
+    swap = get_transform('geographic', 'geographic', order=['lat', 'lon', 'alt'])
+    assert np.allclose(swap(hvec), hvec[..., [1, 0, 2]])
+
+    # transforms are built once and write into out
+    to_hvec = get_transform('cartesian', 'geographic', longitude_modulus=180)
+    assert to_hvec is get_transform('cartesian', 'geographic', longitude_modulus=180)
+    out = np.empty_like(xvec, dtype=np.float32)
+    assert to_hvec(xvec, out=out) is out
+    assert (out[..., 0] < 180).all()
+
+    try:
+        get_transform('cartesian', 'cylindrical')
+    except NotImplementedError:
+        pass
+    else:
+        raise AssertionError('unknown systems should raise')
+
+
+def test_scalar_conversions():
+    random = np.random.RandomState(1)
+    xvec = random.uniform(-1e7, 1e7, (50, 3))
+    xvec[0] = 0 # the origin gives nan angles in both paths
+    xvec[1] = (0, 0, 3e6)
+    for cartesian in (Cartesian(), Cartesian(phi_modulus=2*np.pi, longitude_modulus=180,
+                                             rvec_order=['phi', 'r', 'theta'],
+                                             hvec_order=['alt', 'lat', 'lon'])):
+        for name in ('rvec', 'hvec'):
+            expected = getattr(cartesian, name)(xvec)
+            result = [getattr(cartesian.scalar, name)(tuple(_)) for _ in xvec.tolist()]
+            assert all(type(_) is tuple and type(_[0]) is float for _ in result)
+            assert np.allclose(result, expected, equal_nan=True)
+
+    spherical = Spherical()
+    rvec = Cartesian().rvec(xvec[1:])
+    for name in ('xvec', 'hvec'):
+        expected = getattr(spherical, name)(rvec)
+        result = [getattr(spherical.scalar, name)(_) for _ in rvec.tolist()]
+        assert np.allclose(result, expected)
+
+    geographic = Geographic()
+    hvec = spherical.hvec(rvec)
+    for name in ('xvec', 'rvec'):
+        expected = getattr(geographic, name)(hvec)
+        result = [getattr(geographic.scalar, name)(_) for _ in hvec.tolist()]
+        assert np.allclose(result, expected)
+
+    to_rvec = get_scalar_transform('geographic', 'spherical', order=['phi', 'theta', 'r'],
+                                   src_order=['alt', 'lat', 'lon'])
+    assert np.allclose(to_rvec((0., 0., 0.)), (0, np.pi/2, 6371*1000))
+    assert get_scalar_transform('cartesian', 'cartesian', order='zyx')((1., 2., 3.)) == (3., 2., 1.)
+
+
+def test_ellipsoid():
+    random = np.random.RandomState(2)
+    n = 1000
+    hvec = np.stack((random.uniform(0, 360, n),
+                     random.uniform(-90, 90, n),
+                     random.uniform(-1e5, 1e8, n)), axis=-1)
+    geographic = Geographic(ellipsoid='wgs84')
+    cartesian = Cartesian(ellipsoid='wgs84', hvec_order=['lat', 'lon', 'alt'])
+
+    # equator and poles
+    a, f = ellipsoids['wgs84']
+    assert np.allclose(geographic.xvec((0, 0, 0)), (a, 0, 0))
+    assert np.allclose(geographic.xvec((0, 90, 10)), (0, 0, a*(1-f) + 10))
+    assert np.allclose(cartesian.hvec((0, 0, a*(1-f))), (90, 0, 0))
+
+    xvec = geographic.xvec(hvec)
+    assert np.allclose(cartesian.hvec(xvec), hvec[..., [1, 0, 2]], rtol=1e-12, atol=1e-6)
+    assert np.allclose(geographic.rvec(hvec), Cartesian(phi_modulus=2*np.pi).rvec(xvec))
+    assert np.allclose(np.stack((geographic.x(lon=hvec[:, 0], lat=hvec[:, 1], alt=hvec[:, 2]),
+                                 geographic.y(lon=hvec[:, 0], lat=hvec[:, 1], alt=hvec[:, 2]),
+                                 geographic.z(lat=hvec[:, 1], alt=hvec[:, 2])), axis=-1), xvec)
+    assert np.allclose(geographic.r(lat=hvec[:, 1], alt=hvec[:, 2]), np.linalg.norm(xvec, axis=-1))
+    x, y, z = xvec.T
+    assert np.allclose(cartesian.alt(x=x, y=y, z=z), hvec[:, 2], atol=1e-6)
+    assert np.allclose(cartesian.lat(x=x, y=y, z=z), hvec[:, 1])
+
+    # the evolute and equatorial disc near the geocenter
+    xvec = random.uniform(-5e4, 5e4, (n, 3))
+    xvec[:10, 2] = 0
+    xvec[0] = 0
+    inner = cartesian.hvec(xvec)[..., [1, 0, 2]]
+    assert np.allclose(geographic.xvec(inner), xvec, atol=1e-6)
+    point = np.array([1e3, 2e3, 3e3])
+    assert np.allclose(geographic.xvec(cartesian.hvec(point)[[1, 0, 2]]), point, atol=1e-6)
+    assert np.allclose(ecef_to_geodetic(tuple(point)), cartesian.hvec(point)[[1, 0, 2]])
+
+    # scalar path and spherical round trip
+    rvec = geographic.rvec(hvec)
+    for vec, expected in zip(xvec.tolist(), cartesian.hvec(xvec)):
+        assert np.allclose(cartesian.scalar.hvec(vec), expected, atol=1e-6)
+    for vec, expected in zip(hvec.tolist(), rvec):
+        assert np.allclose(geographic.scalar.rvec(vec), expected)
+    to_geodetic = get_transform('spherical', 'geographic', ellipsoid='wgs84')
+    assert np.allclose(to_geodetic(rvec), hvec, rtol=1e-12, atol=1e-6)
+    to_geodetic = get_scalar_transform('spherical', 'geographic', ellipsoid=(a, f))
+    assert np.allclose(to_geodetic(rvec[0].tolist()), hvec[0])
+
+    # spherical earth is unchanged
+    assert get_transform('geographic', 'cartesian', ellipsoid=None) is \
+        get_transform('geographic', 'cartesian')
@@ -0,0 +1,364 @@
+from kamodo import kamodofy
+import numpy as np
+
+from kamodo_geometry.coordinates import CachedKamodo, ExpressionCache, vec_dtype
+
+
+# # Magnetospheric frames
+#
+# Time-dependent rotations between the cartesian frames of space physics,
+# following the definitions of Hapgood (1992), Planet. Space Sci. 40:711-717:
+#
+# * GEI - geocentric equatorial inertial (mean equator and equinox of date)
+# * GEO - geographic, rotating with the earth
+# * GSE - geocentric solar ecliptic
+# * GSM - geocentric solar magnetospheric
+# * SM  - solar magnetic
+# * MAG - geomagnetic
+#
+# The sun's position uses the low-precision formulae of the Astronomical
+# Almanac (about 0.01 deg). The dipole axis comes from the IGRF degree-1
+# coefficients, interpolated linearly between epochs and held constant after
+# the last one. Each frame is represented by its rotation from GEI, so any
+# pair of frames is connected by a single (N, 3, 3) matrix stack.
+
+frames = ('gei', 'geo', 'gse', 'gsm', 'sm', 'mag')
+
+# 2000-01-01T12:00:00 UTC in seconds since the unix epoch
+j2000 = 946728000.
+
+# IGRF dipole coefficients g10, g11, h11 [nT] by epoch; 2025 from the IGRF-13 secular variation
+igrf_dipole = np.array([
+    (1965., -30334., -2119., 5776.),
+    (1970., -30220., -2068., 5737.),
+    (1975., -30100., -2013., 5675.),
+    (1980., -29992., -1956., 5604.),
+    (1985., -29873., -1905., 5500.),
+    (1990., -29775., -1848., 5406.),
+    (1995., -29692., -1784., 5306.),
+    (2000., -29619.4, -1728.2, 5186.1),
+    (2005., -29554.63, -1669.05, 5077.99),
+    (2010., -29496.57, -1586.42, 4944.26),
+    (2015., -29441.46, -1501.77, 4795.99),
+    (2020., -29404.8, -1450.9, 4652.5),
+    (2025., -29376.3, -1413.9, 4523.0),
+])
+
+
+def time_seconds(t):
+    """seconds since the unix epoch of datetime64 values, datetimes or date strings
+
+    numbers are taken to be seconds since the unix epoch already.
+    """
+    t = np.asarray(t)
+    if np.issubdtype(t.dtype, np.number):
+        return t.astype(float)
+    t = t.astype('datetime64[ns]')
+    return (t - np.datetime64('1970-01-01T00:00:00', 'ns'))/np.timedelta64(1, 's')
+
+
+def normalize(vec):
+    return vec/np.linalg.norm(vec, axis=-1, keepdims=True)
+
+
+def basis(x, y, z):
+    """rotation matrices whose rows are the unit vectors x, y, z"""
+    return np.stack((x, y, z), axis=-2)
+
+
+def dipole_geo(seconds):
+    """unit vectors of the northern dipole pole in GEO"""
+    year = 1970 + seconds/(365.25*86400)
+    g10, g11, h11 = [np.interp(year, igrf_dipole[:, 0], igrf_dipole[:, i]) for i in (1, 2, 3)]
+    return normalize(-np.stack((g11, h11, g10), axis=-1))
+
+
+def frame_matrices(frame, seconds):
+    """(N, 3, 3) rotations from GEI to frame at the given unix seconds"""
+    seconds = np.atleast_1d(seconds)
+    if frame == 'gei':
+        return np.broadcast_to(np.eye(3), seconds.shape + (3, 3)).copy()
+
+    d = (seconds - j2000)/86400
+    gmst = np.radians(280.46061837 + 360.98564736629*d)
+    zero, one = np.zeros_like(d), np.ones_like(d)
+    geo = basis(np.stack((np.cos(gmst), np.sin(gmst), zero), axis=-1),
+                np.stack((-np.sin(gmst), np.cos(gmst), zero), axis=-1),
+                np.stack((zero, zero, one), axis=-1))
+    if frame == 'geo':
+        return geo
+
+    if frame == 'mag':
+        pole = dipole_geo(seconds)
+        y = normalize(np.cross(np.stack((zero, zero, one), axis=-1), pole))
+        return np.matmul(basis(np.cross(y, pole), y, pole), geo)
+
+    mean_anomaly = np.radians(357.529 + 0.98560028*d)
+    ecliptic_longitude = np.radians(280.459 + 0.98564736*d
+                                    + 1.915*np.sin(mean_anomaly)
+                                    + 0.020*np.sin(2*mean_anomaly))
+    obliquity = np.radians(23.439 - 3.6e-7*d)
+    sun = np.stack((np.cos(ecliptic_longitude),
+                    np.cos(obliquity)*np.sin(ecliptic_longitude),
+                    np.sin(obliquity)*np.sin(ecliptic_longitude)), axis=-1)
+    if frame == 'gse':
+        pole = np.stack((zero, -np.sin(obliquity), np.cos(obliquity)), axis=-1)
+        return basis(sun, np.cross(pole, sun), pole)
+
+    # dipole axis in GEI, i.e. the transpose of geo applied to the GEO axis
+    dipole = np.einsum('nji,nj->ni', geo, dipole_geo(seconds))
+    y = normalize(np.cross(dipole, sun))
+    if frame == 'gsm':
+        return basis(sun, y, np.cross(sun, y))
+    if frame == 'sm':
+        return basis(np.cross(y, dipole), y, dipole)
+    raise NotImplementedError('unknown frame: {}'.format(frame))
+
+
+# ## Rotation cache
+#
+# Trajectories often repeat timestamps or are sampled more finely than the
+# rotations change, so times may be grouped into bins of resolution seconds
+# and each frame's rotation computed once per bin, at the bin's center. Cache
+# entries hold the rotations of block_size consecutive bins, filled in as
+# their bins are requested. Bins spread more thinly than a quarter of a
+# block are computed directly, as the lookups would cost more than the
+# rotations and evict the entries of dense trajectories.
+
+block_size = 64
+
+class RotationCache(ExpressionCache):
+    """bounded, process-wide LRU cache of frame rotation matrices
+
+    keys are (frame, resolution, block of bins), values (block_size, 3, 3)
+    arrays and the (block_size,) mask of bins computed so far
+    """
+    def __init__(self, maxsize=4096):
+        super(RotationCache, self).__init__(maxsize)
+
+
+rotation_cache = RotationCache()
+
+
+def cached_matrices(frame, bins, resolution):
+    """rotations from GEI to frame at the center of each of the sorted integer time bins"""
+    blocks = bins // block_size
+    edges = np.flatnonzero(np.diff(blocks)) + 1
+    if len(bins) < (len(edges) + 1)*block_size//4:
+        # too few bins per block for a cache lookup to beat computing them
+        return frame_matrices(frame, (bins + 0.5)*resolution)
+
+    result = np.empty((len(bins), 3, 3))
+    missing = []
+    for start, end in zip([0] + edges.tolist(), edges.tolist() + [len(bins)]):
+        key = (frame, resolution, blocks[start].item())
+        entry = rotation_cache.get(key)
+        if entry is None:
+            entry = (np.empty((block_size, 3, 3)), np.zeros(block_size, dtype=bool))
+            rotation_cache.put(key, entry)
+        matrices, computed = entry
+        offsets = bins[start:end] % block_size
+        if computed[offsets].all():
+            result[start:end] = matrices[offsets]
+        else:
+            missing.append((start, end, entry))
+
+    if missing:
+        rows = np.concatenate([np.arange(start, end) for start, end, _ in missing])
+        result[rows] = frame_matrices(frame, (bins[rows] + 0.5)*resolution)
+        for start, end, (matrices, computed) in missing:
+            offsets = bins[start:end] % block_size
+            matrices[offsets] = result[start:end]
+            computed[offsets] = True
+    return result
+
+
+def get_rotation(src, dst, t, resolution=None):
+    """(N, 3, 3) rotations from frame src to frame dst at each of N times
+
+    t is as for time_seconds. By default every distinct time is evaluated
+    exactly. If resolution is given, times within the same bin of resolution
+    seconds share one rotation, cached for densely sampled bins.
+    """
+    for frame in (src, dst):
+        if frame not in frames:
+            raise NotImplementedError('unknown frame: {}'.format(frame))
+    seconds = np.ravel(time_seconds(t))
+    if resolution:
+        unique, inverse = np.unique(np.floor(seconds/resolution).astype(np.int64),
+                                    return_inverse=True)
+        matrices = lambda frame: cached_matrices(frame, unique, resolution)
+    else:
+        unique, inverse = np.unique(seconds, return_inverse=True)
+        matrices = lambda frame: frame_matrices(frame, unique)
+    rotation = matrices(dst)
+    if src != 'gei':
+        rotation = np.matmul(rotation, np.swapaxes(matrices(src), -1, -2))
+    return rotation[inverse]
+
+
+def rotate(src, dst, xvec, t, resolution=None, out=None):
+    """rotate (..., 3) positions from frame src to frame dst at times t
+
+    t holds one time per position, or a single time for all of them. out
+    must be C-contiguous if given.
+    """
+    xvec = np.asarray(xvec)
+    shape = np.broadcast(xvec[..., 0], time_seconds(t)).shape + (3,)
+    if out is None:
+        out = np.empty(shape, dtype=vec_dtype([xvec]))
+    elif out.shape != shape:
+        raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+    if not out.flags.c_contiguous:
+        raise ValueError('out must be C-contiguous')
+
+    seconds = np.broadcast_to(time_seconds(t), shape[:-1])
+    rows = np.broadcast_to(xvec, shape).reshape((-1, 3))
+    if seconds.size and (seconds == seconds.flat[0]).all():
+        rotation = get_rotation(src, dst, seconds.flat[0], resolution)[0]
+        np.matmul(rows, rotation.T, out=out.reshape((-1, 3)))
+    else:
+        rotation = get_rotation(src, dst, seconds, resolution)
+        np.einsum('nij,nj->ni', rotation, rows, out=out.reshape((-1, 3)), casting='same_kind')
+    return out
+
+
+# ## Frame classes
+#
+# Each class registers the rotation from its own frame into every other
+# frame as a function of position and time, e.g. GSM().geo(xvec, t).
+
+class Frame(CachedKamodo):
+    """cartesian positions in a magnetospheric frame
+
+    resolution, if given, is the width in seconds of the time bins sharing
+    one rotation. The rotation of GEO drifts by 0.0042 deg per second of
+    resolution at most.
+    """
+    frame = None
+
+    def __init__(self, resolution=None, **kwargs):
+        self.resolution = resolution
+        super(Frame, self).__init__(**kwargs)
+
+        if not kwargs:
+            self._cache_options = (resolution,)
+
+        for dst in frames:
+            if dst != self.frame:
+                self[dst] = self.conversion(dst)
+
+        self._cache_options = None
+
+    def conversion(self, dst):
+        """rotation from this frame into dst"""
+        @kamodofy(hidden_args=['out'])
+        def rotation(xvec, t, out=None):
+            return rotate(self.frame, dst, xvec, t, self.resolution, out)
+
+        rotation.__doc__ = 'rotate (..., 3) positions from {} to {}'.format(
+            self.frame.upper(), dst.upper())
+        return rotation
+
+
+class GEI(Frame):
+    frame = 'gei'
+
+
+class GEO(Frame):
+    frame = 'geo'
+
+
+class GSE(Frame):
+    frame = 'gse'
+
+
+class GSM(Frame):
+    frame = 'gsm'
+
+
+class SM(Frame):
+    frame = 'sm'
+
+
+class MAG(Frame):
+    frame = 'mag'
+
+
+def test_frame_matrices():
+    seconds = time_seconds(np.arange('2000-01-01', '2024-01-01', 97, dtype='datetime64[D]'))
+    for frame in frames:
+        matrices = frame_matrices(frame, seconds)
+        assert np.allclose(np.matmul(matrices, np.swapaxes(matrices, -1, -2)), np.eye(3))
+        assert np.allclose(np.linalg.det(matrices), 1)
+
+    # GMST at J2000 and the dipole pole near 80N, 72W in 2020
+    geo = frame_matrices('geo', j2000)[0]
+    assert np.isclose(np.degrees(np.arctan2(geo[0, 1], geo[0, 0])) % 360, 280.46061837)
+    pole = dipole_geo(time_seconds('2020-01-01'))
+    assert np.isclose(np.degrees(np.arcsin(pole[2])), 80.6, atol=0.1)
+    assert np.isclose(np.degrees(np.arctan2(pole[1], pole[0])), -72.7, atol=0.1)
+
+    # GSM and SM share the y axis, SM and MAG share the z axis
+    assert np.allclose(frame_matrices('gsm', seconds)[:, 1], frame_matrices('sm', seconds)[:, 1])
+    sm_z = frame_matrices('sm', seconds)[:, 2]
+    mag_z = frame_matrices('mag', seconds)[:, 2]
+    assert np.allclose(sm_z, mag_z)
+
+    # the sun is near the vernal equinox direction in late March
+    sun = frame_matrices('gse', time_seconds('2021-03-20T09:37'))[0, 0]
+    assert np.allclose(sun, (1, 0, 0), atol=1e-3)
+
+
+def test_rotate():
+    rotation_cache.clear()
+    random = np.random.RandomState(0)
+    t = np.datetime64('2015-03-17T12:00') + random.randint(0, 3600, 1000).astype('timedelta64[s]')
+    xvec = random.uniform(-10, 10, (1000, 3))
+
+    gsm = GSM()
+    geo = gsm.geo(xvec, t)
+    assert np.allclose(GEO().gsm(geo, t), xvec)
+    assert np.allclose(np.linalg.norm(geo, axis=-1), np.linalg.norm(xvec, axis=-1))
+
+    assert np.allclose(geo, rotate('gsm', 'geo', xvec, t, resolution=1.), atol=1e-3)
+    exact = rotate('gsm', 'geo', xvec, t)
+    assert np.array_equal(geo, exact)
+    coarse = rotate('gsm', 'geo', xvec, t, resolution=600)
+    angle = np.degrees(np.arccos(np.clip(np.sum(normalize(coarse)*normalize(exact), axis=-1), -1, 1)))
+    assert angle.max() < 300*0.0042 + 0.01
+
+    # rotations compose through GEI
+    for src, mid, dst in (('geo', 'gse', 'sm'), ('mag', 'gsm', 'gei')):
+        direct = rotate(src, dst, xvec, t)
+        assert np.allclose(rotate(mid, dst, rotate(src, mid, xvec, t), t), direct)
+
+    # repeated times reuse cached rotations
+    rotate('gsm', 'geo', xvec, t, resolution=10.)
+    info = rotation_cache.info()
+    rotate('gsm', 'geo', xvec, t, resolution=10.)
+    assert rotation_cache.info()['misses'] == info['misses']
+    assert rotation_cache.info()['hits'] > info['hits']
+
+    # one-minute samples share cached minute bins, but are too sparse for second bins
+    t = np.datetime64('2015-03-17T12:00') + np.arange(2000).astype('timedelta64[m]')
+    xvec = random.uniform(-10, 10, (2000, 3))
+    coarse = rotate('gsm', 'geo', xvec, t, resolution=60.)
+    info = rotation_cache.info()
+    assert np.array_equal(rotate('gsm', 'geo', xvec, t, resolution=60.), coarse)
+    assert rotation_cache.info()['misses'] == info['misses']
+    assert rotation_cache.info()['hits'] >= info['hits'] + 2000//block_size
+    rotate('gsm', 'geo', xvec, t, resolution=1.)
+    assert rotation_cache.info()['misses'] == info['misses']
+
+    # a single time for all positions, written into out
+    out = np.empty((2, 3))
+    assert rotate('gse', 'gsm', [[1, 0, 0], [0, 0, 1]], '2020-06-01', out=out) is out
+    assert np.allclose(out[0], (1, 0, 0))
+
+    maxsize = rotation_cache.maxsize
+    try:
+        rotation_cache.maxsize = 10
+        assert rotation_cache.info()['currsize'] == 10
+    finally:
+        rotation_cache.maxsize = maxsize
@@ -0,0 +1,305 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from kamodo_geometry.instrumentation import instrumented
+from kamodo_geometry.space import cached_grid
+from kamodo_geometry.spatial import PointIndex
+
+
+# # Great-circle distances
+#
+# Distances between geographic (lon, lat[, alt]) positions on a sphere of
+# the mean earth radius, ignoring altitude. Full distance matrices are
+# computed in blocks of rows whose size bounds the memory used, as a matrix
+# product of unit vectors. Nearest-k and within-radius queries go through a
+# k-d tree of unit vectors instead, whose chord distances order the same way
+# as great-circle distances, so they never visit all pairs.
+
+def unit_vectors(hvec):
+    """(..., 3) unit vectors of (..., 2 or 3) lon, lat [deg] positions"""
+    hvec = np.asarray(hvec, dtype=float)
+    lon = np.radians(hvec[..., 0])
+    lat = np.radians(hvec[..., 1])
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def chord_angle(chord):
+    """central angle subtended by a unit-sphere chord"""
+    return 2*np.arcsin(np.minimum(chord/2, 1))
+
+
+def angle_chord(angle):
+    """unit-sphere chord subtending a central angle"""
+    return 2*np.sin(np.minimum(angle, np.pi)/2)
+
+
+def block_angles(a, b, out):
+    """central angles between unit vectors a (n, 3) and b (m, 3), into out (n, m)
+
+    The angle follows from the dot product 1 - chord**2/2, which loses
+    precision for nearby points; angles below 1e-3 rad are recomputed from
+    the exact chord.
+    """
+    np.matmul(a, b.T, out=out)
+    np.subtract(1, out, out=out)
+    np.maximum(out, 0, out=out)
+    np.multiply(out, 2, out=out)
+    np.sqrt(out, out=out) # chord
+    if out.size:
+        close = np.flatnonzero(out.min(axis=1) < 1e-3)
+        rows, cols = np.nonzero(out[close] < 1e-3)
+        rows = close[rows]
+        out[rows, cols] = np.linalg.norm(a[rows] - b[cols], axis=-1)
+    np.divide(out, 2, out=out)
+    np.minimum(out, 1, out=out)
+    np.arcsin(out, out=out)
+    np.multiply(out, 2, out=out)
+    return out
+
+
+def block_rows(n, m, block_size):
+    """slices of n rows such that each (rows, m) block holds about block_size elements"""
+    rows = max(1, block_size // max(m, 1))
+    return [slice(start, min(start + rows, n)) for start in range(0, n, rows)]
+
+
+def iter_pairwise(hvec_a, hvec_b, radius=6371*1000, block_size=2**22, workers=1):
+    """yield (rows, distances) for blocks of rows of the a x b distance matrix
+
+    a and b are flattened to (n, 2 or 3) and (m, 2 or 3). Each block has
+    shape (len(rows), m) and about block_size elements, so memory stays
+    bounded by workers*block_size whatever n and m are. Blocks are yielded in
+    order, computed on workers threads.
+
+    example:
+        >>> nearest = np.empty(len(stations))
+        >>> for rows, d in iter_pairwise(stations, ground_track):
+        ...     nearest[rows] = d.min(axis=1)
+    """
+    a = unit_vectors(hvec_a).reshape((-1, 3))
+    b = unit_vectors(hvec_b).reshape((-1, 3))
+
+    def distances(rows):
+        out = block_angles(a[rows], b, np.empty((rows.stop - rows.start, len(b))))
+        return rows, np.multiply(out, radius, out=out)
+
+    slices = block_rows(len(a), len(b), block_size)
+    if workers > 1 and len(slices) > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            # at most 2*workers blocks in flight
+            pending = [executor.submit(distances, _) for _ in slices[:2*workers]]
+            for i in range(len(slices)):
+                rows, block = pending[i].result()
+                pending[i] = None
+                if i + 2*workers < len(slices):
+                    pending.append(executor.submit(distances, slices[i + 2*workers]))
+                yield rows, block
+    else:
+        for rows in slices:
+            yield distances(rows)
+
+
+def pairwise(hvec_a, hvec_b, radius=6371*1000, block_size=2**22, workers=1, out=None):
+    """great-circle distances between all positions of a and b, shaped a.shape[:-1] + b.shape[:-1]
+
+    out may be given as a C-contiguous array, e.g. a np.memmap for matrices larger than memory.
+    """
+    shape = np.shape(hvec_a)[:-1] + np.shape(hvec_b)[:-1]
+    if out is None:
+        out = np.empty(shape)
+    elif out.shape != shape:
+        raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+    if not out.flags.c_contiguous:
+        # reshaping would copy, and the distances would not reach out
+        raise ValueError('out must be C-contiguous')
+    flat = out.reshape((int(np.prod(np.shape(hvec_a)[:-1])), -1))
+    for rows, block in iter_pairwise(hvec_a, hvec_b, radius, block_size, workers):
+        flat[rows] = block
+    return out
+
+
+def nearest(hvec, sources, k=1, radius=6371*1000, max_distance=np.inf,
+            block_size=2**20, workers=1):
+    """great-circle distances and indices of the k nearest sources to each position
+
+    Returns arrays shaped like hvec without the last axis, plus a trailing
+    axis of length k if k > 1, like PointIndex.query. Indices refer to the
+    flattened sources. Sources farther than max_distance are missing, with
+    infinite distance and index len(sources). Positions are queried in
+    blocks of block_size/k, on workers threads.
+    """
+    index = PointIndex(unit_vectors(sources))
+    targets = unit_vectors(hvec)
+    shape = targets.shape[:-1] + ((k,) if k > 1 else ())
+    targets = targets.reshape((-1, 3))
+    distance = np.empty((len(targets), k))
+    indices = np.empty((len(targets), k), dtype=np.intp)
+    bound = angle_chord(max_distance/radius) if np.isfinite(max_distance) else np.inf
+    for rows in block_rows(len(targets), k, block_size):
+        chord, i = index.query(targets[rows], k=k, distance_upper_bound=bound, workers=workers)
+        distance[rows] = chord.reshape((-1, k))
+        indices[rows] = i.reshape((-1, k))
+    found = np.isfinite(distance)
+    distance[found] = radius*chord_angle(distance[found])
+    return distance.reshape(shape), indices.reshape(shape)
+
+
+def within(hvec, sources, distance, radius=6371*1000, block_size=2**16, workers=1):
+    """sources within great-circle distance of each of the flattened positions
+
+    Returns (indptr, indices, distances) in compressed sparse row form, as
+    PointIndex.query_radius with return_distance. Positions are queried in
+    blocks of block_size, so only one block of neighbor lists is held at a
+    time besides the result.
+    """
+    index = PointIndex(unit_vectors(sources))
+    targets = unit_vectors(hvec).reshape((-1, 3))
+    chord = angle_chord(distance/radius)
+    counts, indices, distances = [np.zeros(1, dtype=np.intp)], [], []
+    for rows in block_rows(len(targets), 1, block_size):
+        indptr, i, d = index.query_radius(targets[rows], chord, return_distance=True,
+                                          workers=workers)
+        counts.append(np.diff(indptr))
+        indices.append(i)
+        distances.append(radius*chord_angle(d))
+    indptr = np.cumsum(np.concatenate(counts))
+    if not indices:
+        return indptr, np.empty(0, dtype=np.intp), np.empty(0)
+    return indptr, np.concatenate(indices), np.concatenate(distances)
+
+
+# ## Great-circle paths
+#
+# Evaluation grids along geodesics, e.g. for sampling a model along a
+# satellite ground track. Like the generators in `space.py`, the result is
+# a (lon, lat, alt) tuple that plot_dict maps to a function's arguments.
+
+@instrumented('geodesic.great_circle')
+@cached_grid
+def great_circle(lon_1=0., lat_1=0., lon_2=90., lat_2=0., n=101, alt_1=0., alt_2=None,
+                 longitude_modulus=360.):
+    """n points along the shorter great circle from (lon_1, lat_1) to (lon_2, lat_2) [deg]
+
+    Points are equally spaced in angle, with altitude varying linearly from
+    alt_1 to alt_2 (default alt_1). Raises ValueError for antipodal ends,
+    whose great circle is undefined.
+    """
+    a, b = unit_vectors([(lon_1, lat_1), (lon_2, lat_2)])
+    angle = chord_angle(np.linalg.norm(a - b))
+    if np.pi - angle < 1e-9:
+        raise ValueError('great circle between antipodal points is undefined')
+    t = np.linspace(0, 1, n)[:, np.newaxis]
+    if angle > 0:
+        points = (np.sin((1 - t)*angle)*a + np.sin(t*angle)*b)/np.sin(angle)
+    else:
+        points = np.broadcast_to(a, (n, 3))
+    lon = np.degrees(np.arctan2(points[:, 1], points[:, 0])) % longitude_modulus
+    lat = np.degrees(np.arcsin(np.clip(points[:, 2], -1, 1)))
+    alt = np.linspace(alt_1, alt_1 if alt_2 is None else alt_2, n)
+    return lon, lat, alt
+
+
+def path_length(lon, lat, radius=6371*1000):
+    """great-circle length of a path through (lon, lat) [deg] points"""
+    xvec = unit_vectors(np.stack((lon, lat), axis=-1))
+    return radius*chord_angle(np.linalg.norm(np.diff(xvec, axis=0), axis=-1)).sum()
+
+
+def haversine(hvec_a, hvec_b, radius=6371*1000):
+    """reference elementwise great-circle distance"""
+    lon_a, lat_a = np.radians(hvec_a[..., 0]), np.radians(hvec_a[..., 1])
+    lon_b, lat_b = np.radians(hvec_b[..., 0]), np.radians(hvec_b[..., 1])
+    h = np.sin((lat_b - lat_a)/2)**2 + np.cos(lat_a)*np.cos(lat_b)*np.sin((lon_b - lon_a)/2)**2
+    return 2*radius*np.arcsin(np.sqrt(h))
+
+
+def random_positions(n, random):
+    return np.stack((random.uniform(-180, 180, n),
+                     np.degrees(np.arcsin(random.uniform(-1, 1, n))),
+                     random.uniform(0, 1e6, n)), axis=-1)
+
+
+def test_pairwise():
+    random = np.random.RandomState(0)
+    a = random_positions(300, random).reshape((20, 15, 3))
+    b = random_positions(200, random)[:, :2]
+    expected = haversine(a[:, :, np.newaxis, :], b)
+
+    d = pairwise(a, b, block_size=1000)
+    assert d.shape == (20, 15, 200)
+    assert np.allclose(d, expected, rtol=1e-9, atol=1e-6)
+    assert np.allclose(pairwise(a, b, block_size=500, workers=3), d)
+    out = np.empty((20, 15, 200))
+    assert pairwise(a, b, block_size=1000, out=out) is out
+    assert np.allclose(out, d)
+    try:
+        pairwise(a, b, out=np.empty((200, 15, 20)).T)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('non-contiguous out should be rejected')
+
+    # nearby and identical points keep full precision
+    close = a[0, :5] + [1e-7, -1e-7, 0]
+    assert np.allclose(pairwise(a[0, :5], close).diagonal(),
+                       haversine(a[0, :5], close), rtol=1e-6)
+    assert (pairwise(b, b).diagonal() == 0).all()
+
+    blocks = list(iter_pairwise(a, b, block_size=4000))
+    assert [rows for rows, _ in blocks] == [slice(0, 20), slice(20, 40), slice(40, 60),
+                                            slice(60, 80), slice(80, 100), slice(100, 120),
+                                            slice(120, 140), slice(140, 160),
+                                            slice(160, 180), slice(180, 200),
+                                            slice(200, 220), slice(220, 240),
+                                            slice(240, 260), slice(260, 280),
+                                            slice(280, 300)]
+
+
+def test_nearest_within():
+    random = np.random.RandomState(1)
+    stations = random_positions(500, random)
+    track = random_positions(2000, random)
+    d = pairwise(stations, track)
+
+    distance, index = nearest(stations, track, k=3, block_size=100)
+    assert distance.shape == index.shape == (500, 3)
+    assert np.allclose(distance, np.sort(d, axis=1)[:, :3], rtol=1e-9, atol=1e-6)
+    distance, index = nearest(stations, track, max_distance=1e5)
+    missing = index == len(track)
+    assert missing.any() and np.isinf(distance[missing]).all()
+    assert (index[~missing] == d.argmin(axis=1)[~missing]).all()
+
+    indptr, indices, distances = within(stations, track, 5e5, block_size=64)
+    assert indptr[-1] == (d <= 5e5).sum() == len(indices)
+    for i in (0, 17, 499):
+        assert (indices[indptr[i]:indptr[i+1]] == np.flatnonzero(d[i] <= 5e5)).all()
+    assert np.allclose(distances, d[np.repeat(np.arange(500), np.diff(indptr)), indices])
+
+
+def test_great_circle():
+    from kamodo_geometry.space import plot_dict
+    from kamodo_geometry.coordinates import Geographic
+    lon, lat, alt = great_circle(lon_1=-75., lat_1=40., lon_2=2., lat_2=49., n=201,
+                                 alt_1=1e4, alt_2=2e4)
+    assert lon.shape == lat.shape == alt.shape == (201,)
+    ends = np.array([[lon[0], lat[0]], [lon[-1], lat[-1]]])
+    assert np.allclose(ends, [[285., 40.], [2., 49.]])
+    total = haversine(np.array([-75., 40.]), np.array([2., 49.]))
+    assert np.isclose(path_length(lon, lat), total)
+    steps = haversine(np.stack((lon[:-1], lat[:-1]), -1), np.stack((lon[1:], lat[1:]), -1))
+    assert np.allclose(steps, total/200)
+    assert np.allclose(alt[[0, -1]], [1e4, 2e4])
+
+    def x(lon, lat, alt):
+        return Geographic().x(lon=lon, lat=lat, alt=alt)
+
+    assert np.allclose(x(**plot_dict(x, great_circle(n=5))),
+                       6371e3*np.cos(np.radians([0, 22.5, 45, 67.5, 90])))
+
+    try:
+        great_circle(lon_1=0., lat_1=0., lon_2=180., lat_2=0.)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('antipodal great circles are undefined')
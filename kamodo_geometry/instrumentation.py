@@ -0,0 +1,154 @@
+from decorator import decorate
+import threading
+import time
+import numpy as np
+
+
+# # Instrumentation
+#
+# Opt-in timing and counters for the functions registered on `Spherical`,
+# `Cartesian` and `Geographic` and for the grid generators in `space.py`.
+# Instrumented functions check a single flag per call while disabled.
+
+class Instrumentation(object):
+    """per-function call counts, element counts, wall time and output bytes
+
+    example:
+        >>> instrumentation.enable()
+        >>> Cartesian().hvec(xvec)
+        >>> instrumentation.export()['Cartesian.hvec']
+        {'calls': 1, 'elements': 3000, 'seconds': 0.0001, 'bytes': 24000}
+
+    elements and bytes count the arrays returned by each call. If a callback
+    is given, it is called as callback(name, record) after every call, where
+    record holds the same keys for that call alone.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.callback = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.enable(self.callback)
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def enable(self, callback=None):
+        """start recording, optionally emitting each call to callback"""
+        self.callback = callback
+        self.enabled = True
+
+    def disable(self):
+        """stop recording, keeping the statistics gathered so far"""
+        self.enabled = False
+
+    def reset(self):
+        """discard all statistics"""
+        with self._lock:
+            self._stats.clear()
+
+    def export(self):
+        """statistics as a dictionary keyed by function name"""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def record(self, name, seconds, result):
+        """add one call of name returning result after seconds"""
+        arrays = result if isinstance(result, (tuple, list)) else (result,)
+        record = dict(calls=1,
+                      elements=sum(int(np.size(_)) for _ in arrays),
+                      seconds=seconds,
+                      bytes=sum(getattr(_, 'nbytes', 0) for _ in arrays))
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = dict(record)
+            else:
+                for key, value in record.items():
+                    stats[key] += value
+        if self.callback is not None:
+            self.callback(name, record)
+
+
+instrumentation = Instrumentation()
+
+
+def instrument(func, name):
+    """wrap func so its calls are recorded under name while instrumentation is enabled
+
+    The signature and attributes of func are preserved, so the result may
+    be registered with Kamodo.
+    """
+    def recording(f, *args, **kwargs):
+        if not instrumentation.enabled:
+            return f(*args, **kwargs)
+        t0 = time.perf_counter()
+        result = f(*args, **kwargs)
+        instrumentation.record(name, time.perf_counter() - t0, result)
+        return result
+
+    wrapper = decorate(func, recording)
+    wrapper.instrumented = name
+    return wrapper
+
+
+def instrumented(name):
+    """decorator form of instrument"""
+    return lambda func: instrument(func, name)
+
+
+def test_instrumentation():
+    calls = []
+
+    @instrumented('f')
+    def f(x, y=1):
+        return x*y, np.zeros(3)
+
+    instrumentation.reset()
+    f(np.ones(5))
+    assert instrumentation.export() == {}
+
+    with instrumentation:
+        f(np.ones(5), y=2)
+    instrumentation.enable(lambda name, record: calls.append((name, record)))
+    f(np.ones((2, 2)))
+    instrumentation.disable()
+
+    stats = instrumentation.export()['f']
+    assert stats['calls'] == 2
+    assert stats['elements'] == 5 + 3 + 4 + 3
+    assert stats['bytes'] == 8*stats['elements']
+    assert stats['seconds'] > 0
+    assert [name for name, _ in calls] == ['f']
+    assert calls[0][1]['elements'] == 7
+
+    import inspect
+    assert list(inspect.signature(f).parameters) == ['x', 'y']
+    instrumentation.reset()
+    instrumentation.callback = None
+
+
+def test_instrumented_modules():
+    from kamodo_geometry.coordinates import Cartesian, Geographic
+    from kamodo_geometry import space
+    cartesian = Cartesian()
+    geographic = Geographic()
+    xvec = np.random.RandomState(0).uniform(-1e7, 1e7, (100, 3))
+
+    instrumentation.reset()
+    with instrumentation:
+        cartesian.hvec(xvec)
+        Cartesian().rvec(xvec)
+        geographic.x(alt=0, lat=0, lon=0)
+        space.shell(ntheta=10, nphi=20)
+    stats = instrumentation.export()
+    instrumentation.reset()
+
+    assert stats['Cartesian.hvec'] == dict(stats['Cartesian.hvec'], calls=1, elements=300,
+                                           bytes=2400)
+    assert stats['Cartesian.rvec']['calls'] == 1
+    assert stats['Geographic.x']['calls'] == 1
+    assert stats['space.shell']['elements'] == 3*10*20
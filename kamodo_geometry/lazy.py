@@ -0,0 +1,59 @@
+import sys
+
+
+# # Lazy module attributes
+#
+# Building a Kamodo object parses every registered signature with sympy, so
+# module-level instances are only constructed on first access, through a
+# module __getattr__ (PEP 562).
+
+def lazy_attributes(module_name, **builders):
+    """module __getattr__ setting each attribute to builders[name]() on first access
+
+    example:
+        >>> __getattr__ = lazy_attributes(__name__, spherical=Spherical)
+    """
+    def __getattr__(name):
+        if name in builders:
+            value = builders[name]()
+            setattr(sys.modules[module_name], name, value)
+            return value
+        raise AttributeError('module {} has no attribute {}'.format(module_name, name))
+    return __getattr__
+
+
+def constructs_kamodo(module_name):
+    """whether importing module_name in a fresh interpreter constructs a Kamodo object"""
+    import subprocess
+    code = '\n'.join([
+        'import kamodo',
+        'calls = []',
+        'init = kamodo.Kamodo.__init__',
+        'def counting(self, *args, **kwargs):',
+        '    calls.append(type(self))',
+        '    init(self, *args, **kwargs)',
+        'kamodo.Kamodo.__init__ = counting',
+        'import {}'.format(module_name),
+        'print(len(calls))'])
+    return int(subprocess.check_output([sys.executable, '-c', code])) > 0
+
+
+def test_lazy_attributes():
+    built = []
+    module = type(sys)('lazy_test_module')
+    sys.modules[module.__name__] = module
+    try:
+        module.__getattr__ = lazy_attributes(module.__name__,
+                                             answer=lambda: built.append(1) or 42)
+        assert 'answer' not in vars(module)
+        assert module.answer == 42
+        assert module.answer == 42
+        assert built == [1] and vars(module)['answer'] == 42
+        try:
+            module.missing
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError('unknown names should raise AttributeError')
+    finally:
+        del sys.modules[module.__name__]
@@ -0,0 +1,394 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import math
+import os
+import numpy as np
+
+from kamodo_geometry.coordinates import vec_dtype
+from kamodo_geometry.space import evaluate_on, evaluate_tile, tile_slices, tiled_grid
+
+
+# # Parallel conversions
+#
+# The fused kernels of `Spherical`, `Cartesian` and `Geographic` are built from
+# numpy ufuncs, which release the GIL. Large inputs are split into row blocks
+# and converted on a thread pool, each worker writing into its own slice of
+# one shared output array.
+
+class ParallelTransformer(object):
+    """run the vector conversions of a coordinate object on a thread pool
+
+    example:
+        >>> with ParallelTransformer(Cartesian(), workers=4) as cart:
+        ...     rvec = cart.rvec(xvec)
+
+    Inputs are (..., 3) arrays. Inputs with fewer than min_rows positions are
+    converted on the calling thread.
+    """
+    def __init__(self, coords, workers=None, min_rows=2**16):
+        self.coords = coords
+        self.workers = workers or os.cpu_count() or 1
+        self.min_rows = min_rows
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """shut down the worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __getattr__(self, name):
+        kernels = self.__dict__['coords'].kernels
+        if name in kernels:
+            return partial_convert(self, name)
+        raise AttributeError('{} has no vector conversion {}'.format(
+            type(self.__dict__['coords']).__name__, name))
+
+    def output(self, vec, out=None):
+        """validate out, or allocate it for the result of converting vec"""
+        if out is None:
+            out = np.empty(vec.shape, dtype=vec_dtype([vec], self.coords.dtype))
+        elif out.shape != vec.shape:
+            raise ValueError('out has shape {}, expected {}'.format(out.shape, vec.shape))
+        if not out.flags.c_contiguous:
+            raise ValueError('out must be C-contiguous')
+        return out
+
+    def convert(self, name, vec, out=None):
+        """apply the named vector conversion, writing into out if given"""
+        kernel = self.coords.kernels[name]
+        vec = as_positions(vec)
+        out = self.output(vec, out)
+
+        rows = vec.reshape((-1, 3))
+        out_rows = out.reshape((-1, 3))
+        bounds = block_bounds(len(rows), self.workers, self.min_rows)
+        if len(bounds) == 1:
+            kernel(rows, out=out_rows)
+            return out
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        futures = [self._executor.submit(kernel, rows[start:end], out=out_rows[start:end])
+                   for start, end in bounds]
+        for future in futures:
+            future.result()
+        return out
+
+
+def partial_convert(transformer, name):
+    def convert(vec, out=None):
+        return transformer.convert(name, vec, out)
+    convert.__name__ = name
+    return convert
+
+
+def block_bounds(n, workers, min_rows):
+    """split n rows into at most workers contiguous (start, end) blocks"""
+    blocks = max(1, min(workers, n // max(min_rows, 1)))
+    edges = np.linspace(0, n, blocks + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def as_positions(vec):
+    """vec as an array of (..., 3) positions, which convert splits into rows"""
+    vec = np.asarray(vec)
+    if vec.shape[-1:] != (3,):
+        raise ValueError('expected (..., 3) positions, got shape {}'.format(vec.shape))
+    return vec
+
+
+# # Process pool
+#
+# Functions that call back into Python, such as Kamodo-wrapped models
+# evaluated on converted coordinates, hold the GIL and do not scale on
+# threads. A process pool avoids the GIL, but pickling large arrays to the
+# workers costs more than the work. Inputs and outputs are instead placed in
+# shared memory blocks, and each worker converts or evaluates its slice in
+# place.
+
+class SharedArray(object):
+    """numpy array backed by a multiprocessing.shared_memory block
+
+    spec is a picklable (name, shape, dtype) description from which another
+    process attaches the same memory with SharedArray.attach(spec).
+    """
+    def __init__(self, shape, dtype, name=None):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        if name is None:
+            size = max(1, int(np.prod(shape))*dtype.itemsize)
+            self.shm = SharedMemory(create=True, size=size)
+        else:
+            self.shm = SharedMemory(name=name)
+        self.spec = (self.shm.name, shape, dtype)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        """unmap the block from this process"""
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views are still referenced, e.g. by a traceback; the mapping
+            # is released with them
+            pass
+
+    def unlink(self):
+        """unmap and destroy the block"""
+        self.close()
+        self.shm.unlink()
+
+
+@contextmanager
+def shared_blocks():
+    """list collecting SharedArrays, all unlinked on exit even after errors"""
+    blocks = []
+    try:
+        yield blocks
+    finally:
+        for block in blocks:
+            block.unlink()
+
+
+def shared_copy(array, blocks):
+    """copy array into a new SharedArray registered in blocks"""
+    shared = SharedArray(np.shape(array), np.result_type(array))
+    blocks.append(shared)
+    shared.array[...] = array
+    return shared
+
+
+def convert_rows(kernel, src, dst, start, end):
+    """worker: convert rows start:end of shared src into shared dst"""
+    src, dst = SharedArray.attach(src), SharedArray.attach(dst)
+    try:
+        kernel(src.array[start:end], out=dst.array[start:end])
+    finally:
+        src.close()
+        dst.close()
+
+
+def evaluate_rows(func, grid, out, rows, positions=None):
+    """worker: evaluate func on rows of a shared sparse grid into shared out"""
+    grid = [SharedArray.attach(_) for _ in grid]
+    out = SharedArray.attach(out)
+    try:
+        out.array[rows] = evaluate_tile(func, [_.array for _ in grid], out.array.shape, rows,
+                                        positions)
+    finally:
+        for block in grid + [out]:
+            block.close()
+
+
+class ProcessTransformer(ParallelTransformer):
+    """run vector conversions and grid evaluation on a pool of processes
+
+    example:
+        >>> with ProcessTransformer(Cartesian(), workers=4) as cart:
+        ...     rvec = cart.rvec(xvec)
+        ...     rho = cart.evaluate_on(rho_model, shell, ntheta=2000, nphi=4000)
+
+    Arrays are exchanged through shared memory rather than pickled: the input
+    is copied once into a shared block, workers write zero-copy slices of a
+    shared output, which is copied once into the result. Kernels and
+    evaluated functions must be picklable, e.g. module level functions.
+    Worker processes start with the first job and are reused until close().
+    Shared blocks are unlinked when each job ends, including on failure.
+    """
+    def __init__(self, coords, workers=None, min_rows=2**16, mp_context=None):
+        super(ProcessTransformer, self).__init__(coords, workers, min_rows)
+        self.mp_context = mp_context
+
+    def executor(self):
+        """the worker pool, started on first use"""
+        if self._executor is None:
+            # workers must register shared blocks with this process's tracker,
+            # or their own trackers would destroy the blocks when they exit
+            resource_tracker.ensure_running()
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=self.mp_context)
+        return self._executor
+
+    def run(self, tasks):
+        """submit (function, args...) tasks and wait for all of them"""
+        futures = [self.executor().submit(*task) for task in tasks]
+        try:
+            for future in futures:
+                future.result()
+        except BrokenProcessPool:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+
+    def convert(self, name, vec, out=None):
+        """apply the named vector conversion, writing into out if given"""
+        kernel = self.coords.kernels[name]
+        vec = as_positions(vec)
+        out = self.output(vec, out)
+        rows = vec.reshape((-1, 3))
+        bounds = block_bounds(len(rows), self.workers, self.min_rows)
+        if len(bounds) == 1:
+            kernel(rows, out=out.reshape((-1, 3)))
+            return out
+
+        with shared_blocks() as blocks:
+            src = shared_copy(rows, blocks)
+            dst = SharedArray(rows.shape, out.dtype)
+            blocks.append(dst)
+            self.run([(convert_rows, kernel, src.spec, dst.spec, start, end)
+                      for start, end in bounds])
+            out.reshape((-1, 3))[...] = dst.array
+        return out
+
+    def evaluate_on(self, func, grid_fn, tile=2**18, **grid_kwargs):
+        """space.evaluate_on with tiles evaluated on the worker processes"""
+        grid, positions = tiled_grid(grid_fn, grid_kwargs)
+        grid = [np.asarray(_) for _ in grid]
+        shape = np.broadcast(*grid).shape
+        slices = tile_slices(shape, tile) if len(shape) else []
+        if len(slices) < 2:
+            return evaluate_on(func, grid_fn, tile, **grid_kwargs)
+
+        # the first tile is evaluated here to find the output dtype
+        first = evaluate_tile(func, grid, shape, slices[0], positions)
+        with shared_blocks() as blocks:
+            shared_grid = [shared_copy(_, blocks) for _ in grid]
+            out = SharedArray(shape, first.dtype)
+            blocks.append(out)
+            out.array[slices[0]] = first
+            self.run([(evaluate_rows, func, [_.spec for _ in shared_grid], out.spec, rows,
+                       positions) for rows in slices[1:]])
+            return out.array.copy()
+
+
+def test_parallel_transformer():
+    from kamodo_geometry.coordinates import Spherical, Cartesian, Geographic
+    xvec = np.random.RandomState(0).uniform(-1, 1, (4, 1000, 3))
+    cartesian = Cartesian(hvec_order=['alt', 'lat', 'lon'])
+
+    with ParallelTransformer(cartesian, workers=3, min_rows=10) as cart:
+        assert np.allclose(cart.rvec(xvec), cartesian.rvec(xvec))
+        out = np.empty_like(xvec)
+        assert cart.hvec(xvec, out=out) is out
+        assert np.allclose(out, cartesian.hvec(xvec))
+        assert cart.rvec(xvec.astype(np.float32)).dtype == np.float32
+
+        try:
+            cart.rvec(xvec[0].T)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('(3, N) inputs should be rejected')
+        try:
+            cart.xvec(xvec)
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError('Cartesian has no xvec kernel')
+
+    rvec = cartesian.rvec(xvec)
+    spherical = ParallelTransformer(Spherical(), workers=2, min_rows=10)
+    assert np.allclose(spherical.xvec(rvec), xvec)
+    spherical.close()
+
+    hvec = Spherical().hvec(rvec)
+    geographic = ParallelTransformer(Geographic(), workers=2, min_rows=10**6)
+    assert np.allclose(geographic.rvec(hvec), Geographic().rvec(hvec))
+    geographic.close()
+
+
+def test_block_bounds():
+    assert block_bounds(10, 4, 100) == [(0, 10)]
+    bounds = block_bounds(1000, 3, 10)
+    assert bounds[0][0] == 0 and bounds[-1][1] == 1000
+    assert all(end == start for (_, end), (start, _) in zip(bounds[:-1], bounds[1:]))
+
+
+def radial_model(x, y, z):
+    """pure python density model, for the process pool tests"""
+    return np.vectorize(lambda *xyz: math.exp(-math.sqrt(sum(_*_ for _ in xyz))))(x, y, z)
+
+
+def linear_model(x, y, z):
+    return x + 2*y + 3*z
+
+
+def failing_model(x, y, z):
+    """fails on the shell tiles with phi beyond pi, which run on the workers"""
+    if np.all(y <= 0):
+        raise RuntimeError('model failed')
+    return x
+
+
+def crashing_model(x, y, z):
+    if np.all(y <= 0):
+        os._exit(1)
+    return x
+
+
+def shared_names():
+    return set(_ for _ in os.listdir('/dev/shm') if _.startswith('psm_'))
+
+
+def test_process_transformer():
+    from kamodo_geometry.coordinates import Cartesian
+    from kamodo_geometry.space import shell, shell_geo
+    before = shared_names()
+    xvec = np.random.RandomState(0).uniform(-1, 1, (4, 1000, 3))
+    cartesian = Cartesian(hvec_order=['alt', 'lat', 'lon'])
+
+    with ProcessTransformer(cartesian, workers=2, min_rows=100) as cart:
+        assert np.allclose(cart.rvec(xvec), cartesian.rvec(xvec))
+        out = np.empty_like(xvec)
+        assert cart.hvec(xvec, out=out) is out
+        assert np.allclose(out, cartesian.hvec(xvec))
+        executor = cart._executor
+        assert cart.rvec(xvec.astype(np.float32)).dtype == np.float32
+        assert cart._executor is executor
+        try:
+            cart.rvec(np.ascontiguousarray(xvec[0].T))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('(3, N) inputs should be rejected')
+
+        rho = cart.evaluate_on(radial_model, shell, tile=100, ntheta=20, nphi=30)
+        assert np.allclose(rho, evaluate_on(radial_model, shell, ntheta=20, nphi=30))
+        rho = cart.evaluate_on(linear_model, shell_geo, tile=100, shell='h-lon', squeeze=False,
+                               h_max=1e6, nh=20, nlon=30)
+        assert np.allclose(rho, linear_model(*shell_geo('h-lon', squeeze=False, h_max=1e6,
+                                                        nh=20, nlon=30)))
+
+        try:
+            cart.evaluate_on(failing_model, shell, tile=100, ntheta=20, nphi=30)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('worker errors should propagate')
+        try:
+            cart.evaluate_on(crashing_model, shell, tile=100, ntheta=20, nphi=30)
+        except BrokenProcessPool:
+            pass
+        else:
+            raise AssertionError('worker crashes should propagate')
+        assert np.allclose(cart.rvec(xvec), cartesian.rvec(xvec))
+    assert cart._executor is None
+    assert shared_names() == before
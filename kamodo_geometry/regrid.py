@@ -0,0 +1,191 @@
+import hashlib
+import os
+import tempfile
+from scipy import sparse
+import numpy as np
+
+from kamodo_geometry.coordinates import get_transform
+from kamodo_geometry.space import GridCache
+from kamodo_geometry.spatial import PointIndex, grid_points
+
+
+# # Regridding
+#
+# Interpolation from a fixed source grid onto a fixed target grid is linear,
+# so the geometry (coordinate conversion, neighbor search, weights) is
+# reduced once to a sparse (targets x sources) matrix. Each new time step is
+# then regridded with a single sparse matrix product. Weights are cached in
+# memory, and optionally on disk, by the contents of both grids.
+
+class WeightCache(GridCache):
+    """LRU cache of sparse interpolation weights bounded by their bytes"""
+    def sizeof(self, weights):
+        return weights.data.nbytes + weights.indices.nbytes + weights.indptr.nbytes
+
+
+weight_cache = WeightCache()
+
+
+def weight_key(source, target, **options):
+    """content hash identifying the weights between source and target positions"""
+    digest = hashlib.sha1()
+    for points in (source, target):
+        points = np.ascontiguousarray(points, dtype=float)
+        digest.update(repr(points.shape).encode())
+        digest.update(points.tobytes())
+    digest.update(repr(sorted(options.items())).encode())
+    return digest.hexdigest()
+
+
+def interpolation_weights(source, target, method='idw', k=4, power=2., radius=np.inf):
+    """sparse (targets x sources) weights from (n, 3) source onto (m, 3) target positions
+
+    method is 'nearest' or 'idw' (inverse distance weighting over the k
+    nearest sources, exact matches taking all the weight). Targets with no
+    source within radius get an empty row.
+    """
+    if method == 'nearest':
+        k = 1
+    elif method != 'idw':
+        raise NotImplementedError('method {} not supported'.format(method))
+    distance, nearest = PointIndex(source).query(target, k=k, distance_upper_bound=radius)
+    distance = distance.reshape((len(target), k))
+    nearest = nearest.reshape((len(target), k))
+    valid = np.isfinite(distance)
+
+    with np.errstate(divide='ignore'):
+        weights = distance**-float(power) if method == 'idw' else np.ones_like(distance)
+    exact = (distance == 0).any(axis=1)
+    weights[exact] = distance[exact] == 0
+    weights[~valid] = 0
+    total = weights.sum(axis=1, keepdims=True)
+    np.divide(weights, total, out=weights, where=total > 0)
+
+    indptr = np.zeros(len(target) + 1, dtype=np.intp)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    return sparse.csr_matrix((weights[valid], nearest[valid], indptr),
+                             shape=(len(target), len(source)))
+
+
+class Regridder(object):
+    """regrid values on fixed source positions onto a fixed target grid
+
+    example:
+        >>> regrid = Regridder(hvec, shell(r=7e6, sparse=True), source_system='geographic')
+        >>> for rho in time_steps:
+        ...     rho_shell = regrid(rho)
+
+    source and target are (..., 3) positions or (x, y, z) grids from the
+    generators in space.py. source_system converts source positions to
+    cartesian first ('spherical' or 'geographic'). Weights are looked up in
+    weight_cache, then in cache_dir if given, before being computed.
+    """
+    def __init__(self, source, target, method='idw', k=4, power=2., radius=np.inf,
+                 source_system='cartesian', cache_dir=None):
+        source = grid_points(source)
+        if source_system != 'cartesian':
+            source = get_transform(source_system, 'cartesian')(source)
+        target = grid_points(target)
+        self.source_shape = source.shape[:-1]
+        self.target_shape = target.shape[:-1]
+        source = source.reshape((-1, 3))
+        target = target.reshape((-1, 3))
+
+        options = dict(method=method, k=k, power=power, radius=radius)
+        self.key = weight_key(source, target, **options)
+        self.weights = weight_cache.get(self.key)
+        if self.weights is None:
+            self.weights = self.load(cache_dir)
+        if self.weights is None:
+            self.weights = interpolation_weights(source, target, **options)
+            self.save(cache_dir)
+        weight_cache.put(self.key, self.weights)
+        self.empty = np.diff(self.weights.indptr) == 0
+
+    def path(self, cache_dir):
+        return os.path.join(cache_dir, 'weights-{}.npz'.format(self.key))
+
+    def load(self, cache_dir):
+        """weights stored in cache_dir, or None"""
+        if cache_dir is None or not os.path.exists(self.path(cache_dir)):
+            return None
+        return sparse.load_npz(self.path(cache_dir)).tocsr()
+
+    def save(self, cache_dir):
+        """store the weights in cache_dir, replacing the file atomically"""
+        if cache_dir is None:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                sparse.save_npz(f, self.weights)
+            os.replace(tmp, self.path(cache_dir))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def __call__(self, values):
+        """regrid values shaped like the source positions, plus any trailing axes
+
+        Targets without sources in range are nan.
+        """
+        values = np.asarray(values)
+        ndim = len(self.source_shape)
+        if values.shape[:ndim] != self.source_shape:
+            raise ValueError('values have shape {}, expected {} leading'.format(
+                values.shape, self.source_shape))
+        trailing = values.shape[ndim:]
+        result = self.weights.dot(values.reshape((self.weights.shape[1], -1)))
+        if self.empty.any():
+            result = result.astype(np.result_type(result, float), copy=False)
+            result[self.empty] = np.nan
+        return result.reshape(self.target_shape + trailing)
+
+
+def test_regridder(tmp_path):
+    from kamodo_geometry.space import shell, planar
+    random = np.random.RandomState(0)
+    hvec = np.stack((random.uniform(0, 360, 3000),
+                     random.uniform(-90, 90, 3000),
+                     random.uniform(0, 1e6, 3000)), axis=-1)
+    xvec = get_transform('geographic', 'cartesian')(hvec)
+    target = shell(r=6.8e6, ntheta=20, nphi=30, sparse=True)
+
+    weight_cache.clear()
+    regrid = Regridder(hvec, target, source_system='geographic', cache_dir=str(tmp_path))
+    assert regrid.weights.shape == (600, 3000)
+    assert np.allclose(regrid.weights.sum(axis=1), 1)
+
+    # constant and linear fields, and a time series along a trailing axis
+    assert np.allclose(regrid(np.full(3000, 2.)), 2)
+    z = regrid(xvec[:, 2])
+    assert z.shape == (30, 20)
+
+    # inverse distance weights of the 4 nearest sources, by brute force
+    targets = grid_points(target).reshape((-1, 3))
+    distance = np.linalg.norm(targets[:, None, :] - xvec, axis=-1)
+    nearest = np.argsort(distance, axis=1)[:, :4]
+    weights = np.take_along_axis(distance, nearest, axis=1)**-2.
+    expected = (weights*xvec[nearest, 2]).sum(axis=1)/weights.sum(axis=1)
+    assert np.allclose(z.ravel(), expected, rtol=1e-12, atol=1e-6)
+    series = np.stack([xvec[:, 2]*i for i in range(5)], axis=-1)
+    assert np.allclose(regrid(series)[..., 3], 3*z)
+
+    # weights come from memory, then from disk
+    assert Regridder(hvec, target, source_system='geographic').weights is regrid.weights
+    weight_cache.clear()
+    assert len(os.listdir(str(tmp_path))) == 1
+    reloaded = Regridder(hvec, target, source_system='geographic', cache_dir=str(tmp_path))
+    assert (reloaded.weights != regrid.weights).nnz == 0
+
+    # nearest neighbor against brute force, and targets out of range
+    targets = grid_points(planar('xy', x_1=-7e6, x_2=7e6, y_1=-7e6, y_2=7e6, nx=7, ny=8))
+    nearest = Regridder(xvec, targets, method='nearest')
+    brute = np.linalg.norm(targets[..., None, :] - xvec, axis=-1).argmin(axis=-1)
+    assert (nearest(np.arange(3000)) == brute).all()
+    bounded = Regridder(xvec, targets, radius=5e5)
+    assert np.isnan(bounded(np.ones(3000))).any()
+
+    # exact matches take all the weight
+    assert np.allclose(Regridder(xvec, xvec[:10])(np.arange(3000.)), np.arange(10))
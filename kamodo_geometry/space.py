@@ -1,8 +1,16 @@
 # +
 from kamodo import Kamodo, kamodofy
 from kamodo import get_defaults, get_args
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decorator import decorate
+import inspect
+import threading
 import numpy as np
 
+from kamodo_geometry.instrumentation import instrumented
+from kamodo_geometry.lazy import lazy_attributes, constructs_kamodo
+
 def optional(d):
     """Get the first value if d is a dicitonary"""
     if isinstance(d, dict):
@@ -20,6 +28,19 @@ def one_dimensional(x_1, x_2, n, space, base):
     else:
         raise NotImplementedError('unknown space: {}'.format(space))
 
+def lazy_kamodofy(**kwargs):
+    """kamodofy, deferring the generated signature latex until it is rendered
+
+    kamodofy builds a sympy equation for every function without an equation,
+    which dominates the import time of this module.
+    """
+    def decorator(f):
+        func = kamodofy(f, equation='', **kwargs)
+        func.meta['equation'] = None
+        func._repr_latex_ = lambda: kamodofy(f, **dict(kwargs, data={}))._repr_latex_()
+        return func
+    return decorator
+
 def plot_dict(func, params):
     """map function arguments to input parameters
     example:
@@ -33,6 +54,145 @@ def plot_dict(func, params):
         raise NotImplementedError('cannot map {} to {} params'.format(keys, len(params)))
 
 
+# -
+
+# ## Grid cache
+#
+# Dashboards replot the same grids with identical parameters. Generator
+# results are memoized on their normalized arguments, with optional() choices
+# resolved, and returned as read-only arrays shared between callers.
+
+# +
+class GridCache(object):
+    """LRU cache of generated grids bounded by the bytes of their arrays"""
+    def __init__(self, max_bytes=256*2**20):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def get(self, key):
+        """retrieve a cached grid, or None if it is not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def sizeof(self, grid):
+        """bytes held by a cached grid"""
+        return sum(_.nbytes for _ in grid_arrays(grid))
+
+    def put(self, key, grid):
+        """store a grid, evicting the least recently used beyond max_bytes"""
+        nbytes = self.sizeof(grid)
+        with self._lock:
+            if nbytes > self._max_bytes:
+                return
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (grid, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def clear(self):
+        """remove all grids and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """cache statistics as a dictionary"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        nbytes=self.nbytes, max_bytes=self._max_bytes)
+
+
+grid_cache = GridCache()
+
+
+def grid_arrays(grid):
+    """the arrays making up a generator result"""
+    if isinstance(grid, np.ndarray):
+        return [grid]
+    return [_ for _ in grid if isinstance(_, np.ndarray)]
+
+
+def read_only(grid, inputs):
+    """mark the arrays of grid read-only, copying any passed through from inputs"""
+    if isinstance(grid, np.ndarray):
+        if any(grid is _ for _ in inputs):
+            grid = grid.copy()
+        grid.setflags(write=False)
+        return grid
+    if isinstance(grid, (list, tuple)):
+        return type(grid)(read_only(_, inputs) for _ in grid)
+    return grid
+
+
+def argument_key(value):
+    """hashable form of a generator argument, or None if it is not cacheable"""
+    value = optional(value)
+    if isinstance(value, np.ndarray):
+        if value.nbytes > 2**16:
+            return None
+        return ('ndarray', value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        items = tuple(argument_key(_) for _ in value)
+        if None in items:
+            return None
+        return (type(value).__name__, items)
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    return (type(value).__name__, value)
+
+
+def cached_grid(f):
+    """memoize a grid generator in grid_cache, returning read-only arrays"""
+    signature = inspect.signature(f)
+
+    def caching(f, *args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(argument_key(_) for _ in bound.arguments.values())
+        if None in key:
+            return f(*args, **kwargs)
+        key = (f.__name__,) + key
+        grid = grid_cache.get(key)
+        if grid is None:
+            grid = read_only(f(*args, **kwargs), list(bound.arguments.values()))
+            grid_cache.put(key, grid)
+        if isinstance(grid, list):
+            return list(grid)
+        return grid
+
+    return decorate(f, caching)
+
+
 # -
 
 # ## 1-dimensional spaces
@@ -40,15 +200,21 @@ def plot_dict(func, params):
 # These functions may be used to generate Cartesian one-dimensional values.
 
 # +
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.x')
+@cached_grid
 def x(x_1=0., x_2=1., n=51, space=dict(linear='linear', log='log'), base=10):
     return one_dimensional(x_1, x_2, n, optional(space), base)
 
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.y')
+@cached_grid
 def y(y_1=0., y_2=1., n=52, space=dict(linear='linear', log='log'), base=10):
     return one_dimensional(y_1, y_2, n, optional(space), base)
 
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.z')
+@cached_grid
 def z(z_1=0., z_2=1., n=53, space=dict(linear='linear', log='log'), base=10):
     return one_dimensional(z_1, z_2, n, optional(space), base)
 
@@ -67,11 +233,14 @@ In the 2-D case with inputs of length M and N, the outputs are of shape
 (N, M) for 'xy' indexing and (M, N) for 'ij' indexing.
 """.replace('\n', '<br>').strip('<br>')
 
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.xy')
+@cached_grid
 def xy(x_1=0., x_2=1., nx=51, xspace=dict(linear='linear', log='log'), xbase=10,
        y_1=0., y_2=1., ny=52, yspace=dict(linear='linear', log='log'), ybase=10,
        z={'None': None, '0': 0},
        squeeze={'True': True, 'False': False},
+       sparse={'False': False, 'True': True},
        indexing={'xy': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
     """create an xy-plane passing through z(optional)
     Todo: implement squeeze
@@ -86,24 +255,27 @@ def xy(x_1=0., x_2=1., nx=51, xspace=dict(linear='linear', log='log'), xbase=10,
             x_, y_ = np.meshgrid(
                 one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
                 one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
-                indexing=optional(indexing))
+                indexing=optional(indexing), sparse=optional(sparse))
             return x_, y_, z_
         return np.meshgrid(
             one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
             one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
             z,
-            indexing=optional(indexing))
+            indexing=optional(indexing), sparse=optional(sparse))
     return np.meshgrid(
         one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
         one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
-        indexing=optional(indexing))
+        indexing=optional(indexing), sparse=optional(sparse))
 
 
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.xz')
+@cached_grid
 def xz(x_1=0., x_2=1., nx=51, xspace=dict(linear='linear', log='log'), xbase=10,
        y={'None': None, '0': 0},
        z_1=0., z_2=1., nz=53, zspace=dict(linear='linear', log='log'), zbase=10,
        squeeze={'True': True, 'False': False},
+       sparse={'False': False, 'True': True},
        indexing={'xz': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
     "create an xz plane passing through y (optional)"
     y_ = optional(y)
@@ -113,24 +285,27 @@ def xz(x_1=0., x_2=1., nx=51, xspace=dict(linear='linear', log='log'), xbase=10,
             x_, z_ = np.meshgrid(
                 one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
                 one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-                indexing=optional(indexing))
+                indexing=optional(indexing), sparse=optional(sparse))
             return x_, y_, z_
         return np.meshgrid(
             one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
             y_,
             one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-            indexing=optional(indexing))
+            indexing=optional(indexing), sparse=optional(sparse))
     else:
         return np.meshgrid(one_dimensional(x_1, x_2, nx, optional(xspace), xbase),
                    one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-                   indexing=optional(indexing))
+                   indexing=optional(indexing), sparse=optional(sparse))
 
-@kamodofy(data={})
+@lazy_kamodofy(data={})
+@instrumented('space.yz')
+@cached_grid
 def yz(x={'None': None, '0': 0},
        y_1=0., y_2=1., ny=52, yspace=dict(linear='linear', log='log'), ybase=10,
        z_1=0., z_2=1., nz=53, zspace=dict(linear='linear', log='log'), zbase=10,
        squeeze={'True': True, 'False': False},
-      indexing={'yz': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
+       sparse={'False': False, 'True': True},
+       indexing={'yz': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
     """create a yz plane passing through x (optional)"""
     x_ = optional(x)
     squeeze = optional(squeeze)
@@ -139,20 +314,18 @@ def yz(x={'None': None, '0': 0},
             y_, z_ = np.meshgrid(
                 one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
                 one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-                indexing=optional(indexing))
+                indexing=optional(indexing), sparse=optional(sparse))
             return x_, y_, z_
         return np.meshgrid(
             x_,
             one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
             one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-            indexing=optional(indexing))
+            indexing=optional(indexing), sparse=optional(sparse))
     else:
         return np.meshgrid(
             one_dimensional(y_1, y_2, ny, optional(yspace), ybase),
             one_dimensional(z_1, z_2, nz, optional(zspace), zbase),
-            indexing=optional(indexing))
-
-cartesian = Kamodo(X=x, Y=y, Z=z, XY=xy, XZ=xz, YZ=yz)
+            indexing=optional(indexing), sparse=optional(sparse))
 
 
 # -
@@ -162,7 +335,9 @@ cartesian = Kamodo(X=x, Y=y, Z=z, XY=xy, XZ=xz, YZ=yz)
 # A more generic form of cartesian plane would be to specify all of the above with defaults
 
 # +
-@kamodofy
+@lazy_kamodofy(data={})
+@instrumented('space.planar')
+@cached_grid
 def planar(
         plane=dict(xy='xy', xz='xz', yz='yz'),
         x_1=0., x_2=1., nx=51, x=0,
@@ -172,10 +347,12 @@ def planar(
         z_1=0., z_2=1., nz=53, z=0,
         zspace=dict(linear='linear', log='log'), zbase=10,
         squeeze={'True': True, 'False': False},
+        sparse={'False': False, 'True': True},
         indexing={'yz': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
     """generic 3d cut plane"""
     plane = optional(plane)
     squeeze=optional(squeeze)
+    sparse = optional(sparse)
     indexing = optional(indexing)
     xspace, yspace, zspace = optionals(xspace, yspace, zspace)
     x_ = one_dimensional(x_1, x_2, nx, xspace, xbase)
@@ -183,32 +360,49 @@ def planar(
     z_ = one_dimensional(z_1, z_2, nz, zspace, zbase)
     if plane == 'xy':
         if squeeze:
-            xx, yy = np.meshgrid(x_, y_, indexing=indexing)
+            xx, yy = np.meshgrid(x_, y_, indexing=indexing, sparse=sparse)
             return xx, yy, z
-        return np.meshgrid(x_, y_, z, indexing=indexing)
+        return np.meshgrid(x_, y_, z, indexing=indexing, sparse=sparse)
     elif plane == 'xz':
         if squeeze:
-            xx, zz = np.meshgrid(x_, z_, indexing=indexing)
+            xx, zz = np.meshgrid(x_, z_, indexing=indexing, sparse=sparse)
             return xx, y, zz
-        return np.meshgrid(x_, y, z_, indexing=indexing)
+        return np.meshgrid(x_, y, z_, indexing=indexing, sparse=sparse)
     elif plane == 'yz':
         if squeeze:
-            yy, zz = np.meshgrid(y_, z_, indexing=indexing)
+            yy, zz = np.meshgrid(y_, z_, indexing=indexing, sparse=sparse)
             return x, yy, zz
-        return np.meshgrid(x, y_, z_, indexing=indexing)
+        return np.meshgrid(x, y_, z_, indexing=indexing, sparse=sparse)
     else:
         raise NotImplementedError('plane {} not supported'.format(plane))
 
-cartesian['planar'] = planar
 
 
 # -
 
-@kamodofy(hidden_args = ['r_min', 'r_max', 'rspace', 'rbase', 'nr',
+# ### Lazy module attributes
+#
+# The cartesian Kamodo of the planar generators is built on first access.
+
+# +
+def build_cartesian():
+    """construct the cartesian grid generators"""
+    cartesian = Kamodo(X=x, Y=y, Z=z, XY=xy, XZ=xz, YZ=yz)
+    cartesian['planar'] = planar
+    return cartesian
+
+__getattr__ = lazy_attributes(__name__, cartesian=build_cartesian)
+
+
+# -
+
+@lazy_kamodofy(data={}, hidden_args = ['r_min', 'r_max', 'rspace', 'rbase', 'nr',
                          'theta_min', 'theta_max', 'ntheta',
                          'phi_min', 'phi_max', 'nphi',
-                         'squeeze', 'indexing','shell',
+                         'squeeze', 'sparse', 'indexing','shell',
                         ])
+@instrumented('space.shell')
+@cached_grid
 def shell(
         shell={'theta-phi':'theta-phi', 'r-theta':'r-theta', 'r-phi':'r-phi'},
         r_min=0., r_max=2., nr=51, r=1.0,
@@ -217,42 +411,70 @@ def shell(
         theta_min=0., theta_max=np.pi, ntheta=52, theta=0,
         phi_min=0., phi_max=2*np.pi, nphi=53, phi=0,
         squeeze={'True': True, 'False': False},
+        sparse={'False': False, 'True': True},
         indexing={'rtheta': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
-    shell = optional(shell)
-    squeeze=optional(squeeze)
-    indexing = optional(indexing)
-    rbase = optional(rbase)
-    rspace = optional(rspace)
+    axes, fixed = shell_axes(shell, r_min, r_max, nr, r, rspace, rbase,
+                             theta_min, theta_max, ntheta, theta, phi_min, phi_max, nphi, phi)
+    return separable_shell(*axes, fixed=fixed, squeeze=optional(squeeze),
+                           indexing=optional(indexing), sparse=optional(sparse))
+
+
+def shell_axes(shell, r_min, r_max, nr, r, rspace, rbase,
+               theta_min, theta_max, ntheta, theta, phi_min, phi_max, nphi, phi, **ignored):
+    """1-d r, theta, phi axes of a shell() surface and the position of the fixed one"""
+    shell, rspace, rbase = optionals(shell, rspace, rbase)
     r_ = one_dimensional(r_min, r_max, nr, rspace, rbase)
     theta_ = one_dimensional(theta_min, theta_max, ntheta, 'linear', 1)
     phi_ = one_dimensional(phi_min, phi_max, nphi, 'linear', 1)
     if shell == 'r-theta':
-        if squeeze:
-            pphi = phi
-            rr, ttheta = np.meshgrid(r_, theta_, indexing=indexing)
-        else:
-            rr, ttheta, pphi = np.meshgrid(r_, theta_, phi, indexing=indexing)
+        return (r_, theta_, phi), 2
     elif shell == 'r-phi':
-        if squeeze:
-            ttheta = theta
-            rr, pphi = np.meshgrid(r_, phi_, indexing=indexing)
-        else:
-            rr, ttheta, pphi = np.meshgrid(r_, theta, phi_, indexing=indexing)
+        return (r_, theta, phi_), 1
     elif shell == 'theta-phi':
-        if squeeze:
-            rr = r
-            ttheta, pphi = np.meshgrid(theta_, phi_, indexing=indexing)
-        else:
-            rr, ttheta, pphi = np.meshgrid(r, theta_, phi_, indexing=indexing)
-    else:
-        raise NotImplementedError('plane {} not supported'.format(shell))
-    x = rr*np.sin(ttheta)*np.cos(pphi)
-    y = rr*np.sin(pphi)*np.sin(ttheta)
-    z = rr*np.cos(ttheta)
+        return (r, theta_, phi_), 0
+    raise NotImplementedError('plane {} not supported'.format(shell))
+
+
+def spherical_grid(r, theta, phi, fixed, squeeze, indexing):
+    """sparse r, theta, phi grids from 1-d axes, the axis at position fixed held constant"""
+    axes = [r, theta, phi]
+    if squeeze:
+        grids = list(np.meshgrid(*[a for i, a in enumerate(axes) if i != fixed],
+                                 indexing=indexing, sparse=True))
+        grids.insert(fixed, axes[fixed])
+        return grids
+    return list(np.meshgrid(*axes, indexing=indexing, sparse=True))
+
+
+def separable_shell(r, theta, phi, fixed, squeeze, indexing, sparse=False):
+    """cartesian x, y, z of a spherical grid built from 1-d r, theta, phi axes
+
+    The axis at position fixed is held constant. sin and cos are evaluated on
+    the 1-d axes only and combined by broadcasting, in the same order as the
+    elementwise expressions so results match a full meshgrid evaluation.
+    If sparse, each of x, y, z only spans the axes it depends on and the
+    three broadcast against each other to the full grid. x and y depend on
+    both axes of the surface, so unlike the planar generators a sparse shell
+    still holds two full (n_u, n_v) arrays; evaluate_on avoids them.
+    """
+    return shell_positions(*spherical_grid(r, theta, phi, fixed, squeeze, indexing),
+                           sparse=sparse)
+
+
+def shell_positions(rr, ttheta, pphi, sparse=False):
+    """cartesian x, y, z of broadcastable r, theta, phi grids"""
+    sin_theta = np.sin(ttheta)
+    if sparse:
+        return rr*sin_theta*np.cos(pphi), rr*np.sin(pphi)*sin_theta, rr*np.cos(ttheta)
+    shape = np.broadcast(rr, ttheta, pphi).shape
+    x = np.multiply(rr*sin_theta, np.cos(pphi), out=np.empty(shape))
+    y = np.multiply(rr*np.sin(pphi), sin_theta, out=np.empty(shape))
+    z = np.multiply(rr, np.cos(ttheta), out=np.empty(shape))
     return x, y, z
 
 
-
+@instrumented('space.shell_geo')
+@cached_grid
 def shell_geo(
         shell={'lat-lon':'lat-lon', 'h-lat':'h-lat', 'h-lon':'h-lon'},      
         h_min=0., h_max=2., nh=51, h=1.0,                                   #dont know if defaults are right
@@ -261,42 +483,298 @@ def shell_geo(
         lat_min=-90., lat_max=90., nlat=52, lat=0,                          #dont know if defaults are right
         lon_min=0., lon_max=360., nlon=53, lon=0,                        #dont know if defaults are right
         squeeze={'True': True, 'False': False},
+        sparse={'False': False, 'True': True},
         indexing={'hlat': 'xy', 'ij':'ij', 'tooltip': meshgrid_tooltip}):
-    shell = optional(shell)
-    squeeze=optional(squeeze)
-    indexing = optional(indexing)
-    hbase = optional(hbase)
-    hspace = optional(hspace)
+    axes, fixed = shell_geo_axes(shell, h_min, h_max, nh, h, hspace, hbase,
+                                 lat_min, lat_max, nlat, lat, lon_min, lon_max, nlon, lon)
+    return separable_shell(*axes, fixed=fixed, squeeze=optional(squeeze),
+                           indexing=optional(indexing), sparse=optional(sparse))
+
+
+def shell_geo_axes(shell, h_min, h_max, nh, h, hspace, hbase,
+                   lat_min, lat_max, nlat, lat, lon_min, lon_max, nlon, lon, **ignored):
+    """1-d r, theta, phi axes of a shell_geo() surface and the position of the fixed one"""
+    shell, hspace, hbase = optionals(shell, hspace, hbase)
     h_ = one_dimensional(h_min, h_max, nh, hspace, hbase)
     lat_ = one_dimensional(lat_min, lat_max, nlat, 'linear', 1)
     lon_ = one_dimensional(lon_min, lon_max, nlon, 'linear', 1)
     if shell == 'h-lat':
-        if squeeze:
-            llon = lon
-            hh, llat = np.meshgrid(h_, lat_, indexing=indexing)
-        else:
-            hh, llat, llon = np.meshgrid(h_, lat_, lon, indexing=indexing)
+        axes, fixed = (h_, lat_, lon), 2
     elif shell == 'h-lon':
-        if squeeze:
-            llat = lat
-            hh, llon = np.meshgrid(h_, lon_, indexing=indexing)
-        else:
-            hh, llat, llon = np.meshgrid(h_, lat, lon_, indexing=indexing)
+        axes, fixed = (h_, lat, lon_), 1
     elif shell == 'lat-lon':
-        if squeeze:
-            hh = h
-            llat, llon = np.meshgrid(lat_, lon_, indexing=indexing)
-        else:
-            hh, llat, llot = np.meshgrid(h, lat_, lon_, indexing=indexing)
+        axes, fixed = (h, lat_, lon_), 0
     else:
         raise NotImplementedError('plane {} not supported'.format(shell))
-    rr = hh + 6371*1000
-    ttheta = (1-(llat/90))*np.pi/2
-    pphi = llon*np.pi/180
-    x = rr*np.sin(ttheta)*np.cos(pphi) 
-    y = rr*np.sin(pphi)*np.sin(ttheta) 
-    z = rr*np.cos(ttheta) 
-    return x, y, z
+    hh, llat, llon = [np.asarray(_) for _ in axes]
+    return (hh + 6371*1000, (1-(llat/90))*np.pi/2, llon*np.pi/180), fixed
+
+
+# shells are tiled on their 1-d spherical axes by evaluate_on
+shell_generators = {shell: shell_axes, shell_geo: shell_geo_axes}
+
+
+# ## Tiled evaluation
+#
+# Expensive functions evaluated over large grids are computed one tile of
+# rows at a time. Planar grids are generated sparse and only broadcast within
+# the current tile. The x and y of a shell span the whole surface even when
+# sparse, so shells are tiled on their 1-d r, theta and phi axes instead and
+# positions are computed per tile. Either way, memory beyond the output is
+# bounded by the tile size.
 
+def tile_slices(shape, tile):
+    """slices along the first axis of shape covering at most tile points each"""
+    rows = max(1, tile // max(1, int(np.prod(shape[1:]))))
+    return [slice(start, start + rows) for start in range(0, shape[0], rows)]
 
 
+def generator_entry(table, grid_fn):
+    """table[grid_fn] for a generator or any wrapper of one, or None"""
+    while grid_fn is not None:
+        if grid_fn in table:
+            return table[grid_fn]
+        grid_fn = getattr(grid_fn, '__wrapped__', None)
+    return None
+
+
+def tiled_grid(grid_fn, grid_kwargs):
+    """sparse grid of grid_fn and the function mapping its tiles to positions, or None
+
+    Shells give their spherical r, theta, phi grids, which bypass grid_cache.
+    """
+    signature = inspect.signature(grid_fn)
+    axes = generator_entry(shell_generators, grid_fn)
+    if axes is not None:
+        signature.bind(**grid_kwargs)
+        params = {k: optional(v) for k, v in dict(get_defaults(grid_fn), **grid_kwargs).items()}
+        (r, theta, phi), fixed = axes(**params)
+        grid = spherical_grid(r, theta, phi, fixed, params['squeeze'], params['indexing'])
+        return grid, shell_positions
+    if 'sparse' in signature.parameters:
+        grid_kwargs = dict(grid_kwargs, sparse=True)
+    return grid_fn(**grid_kwargs), None
+
+
+def evaluate_tile(func, grid, shape, rows, positions=None):
+    """func evaluated on the rows of a sparse grid broadcasting to shape"""
+    tile_grid = [_[rows] if np.ndim(_) == len(shape) and np.shape(_)[0] > 1 else _
+                 for _ in grid]
+    if positions is not None:
+        tile_grid = positions(*tile_grid, sparse=True)
+    tile_shape = (len(range(*rows.indices(shape[0]))),) + shape[1:]
+    result = func(**plot_dict(func, tile_grid))
+    return np.broadcast_to(result, tile_shape)
+
+
+def evaluate_on(func, grid_fn, tile=2**18, workers=1, **grid_kwargs):
+    """evaluate func over the grid of grid_fn(**grid_kwargs), tile by tile
+
+    The grid is split along its first axis into tiles of at most tile points
+    (at least one row). Each tile is mapped to func's arguments with
+    plot_dict and written into one preallocated output. With workers > 1,
+    tiles are evaluated on a thread pool.
+
+    example:
+        >>> rho = evaluate_on(k.rho, shell, tile=10**5, ntheta=2000, nphi=4000)
+        >>> k.plot(rho=plot_dict(k.rho, shell(ntheta=2000, nphi=4000)))
+    """
+    grid, positions = tiled_grid(grid_fn, grid_kwargs)
+    shape = np.broadcast(*grid).shape
+    if len(shape) == 0:
+        if positions is not None:
+            grid = positions(*grid)
+        return np.asarray(func(**plot_dict(func, grid)))
+
+    slices = tile_slices(shape, tile)
+    first = evaluate_tile(func, grid, shape, slices[0], positions)
+    out = np.empty(shape, dtype=first.dtype)
+    out[slices[0]] = first
+
+    def evaluate_into(rows):
+        out[rows] = evaluate_tile(func, grid, shape, rows, positions)
+
+    if workers > 1 and len(slices) > 2:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(evaluate_into, slices[1:]))
+    else:
+        for rows in slices[1:]:
+            evaluate_into(rows)
+    return out
+
+
+def test_import_budget():
+    """importing the module must not construct any Kamodo objects"""
+    assert not constructs_kamodo('kamodo_geometry.space')
+
+    from kamodo_geometry import space
+    assert 'planar' in space.cartesian
+    assert space.cartesian is space.cartesian
+
+
+def dense_shell(r, theta, phi, fixed, squeeze, indexing):
+    """reference evaluation of separable_shell on a fully materialized meshgrid"""
+    axes = [r, theta, phi]
+    if squeeze:
+        grids = list(np.meshgrid(*[a for i, a in enumerate(axes) if i != fixed],
+                                 indexing=indexing))
+        grids.insert(fixed, axes[fixed])
+    else:
+        grids = np.meshgrid(*axes, indexing=indexing)
+    rr, ttheta, pphi = np.broadcast_arrays(*grids)
+    return (rr*np.sin(ttheta)*np.cos(pphi),
+            rr*np.sin(pphi)*np.sin(ttheta),
+            rr*np.cos(ttheta))
+
+
+def test_separable_shell():
+    r_ = one_dimensional(0, 1, 11, 'log', 10)
+    theta_ = one_dimensional(0, np.pi, 12, 'linear', 1)
+    phi_ = one_dimensional(0, 2*np.pi, 13, 'linear', 1)
+    for axes, fixed in (((r_, theta_, 0.5), 2), ((r_, 0.5, phi_), 1), ((2., theta_, phi_), 0)):
+        for squeeze in (True, False):
+            for indexing in ('xy', 'ij'):
+                expected = dense_shell(*axes, fixed=fixed, squeeze=squeeze, indexing=indexing)
+                result = separable_shell(*axes, fixed=fixed, squeeze=squeeze, indexing=indexing)
+                for a, b in zip(expected, result):
+                    assert a.shape == b.shape
+                    assert np.allclose(a, b, rtol=1e-15, atol=0)
+
+    # default squeeze (meshgrid returns a tuple on newer numpy)
+    x, y, z = shell()
+    assert x.shape == (53, 52)
+    assert np.allclose(x**2 + y**2 + z**2, 1)
+    x, y, z = shell_geo()
+    assert x.shape == z.shape
+
+    x, y, z = shell('r-theta', nr=5, ntheta=6, squeeze=False)
+    assert x.shape == (6, 5, 1)
+    assert np.allclose(x**2 + y**2 + z**2, np.linspace(0, 2, 5)[None, :, None]**2)
+
+    for mode, h_min, h_max in (('lat-lon', 1000, 1000), ('h-lat', 0, 2), ('h-lon', 0, 2)):
+        for squeeze in (True, False):
+            x, y, z = shell_geo(mode, squeeze=squeeze, h=1000.)
+            alt = np.sqrt(x**2 + y**2 + z**2) - 6371*1000
+            assert np.all((alt > h_min - 1e-6) & (alt < h_max + 1e-6))
+
+
+def test_grid_cache():
+    grid_cache.clear()
+    xx, yy = xy(nx=5, ny=6)
+    assert grid_cache.info()['misses'] == 1
+    xx_, yy_ = xy(nx=5, ny=6, indexing='xy')
+    assert xx_ is xx
+    assert grid_cache.info()['hits'] == 1
+    assert not xx.flags.writeable
+
+    # optional choices are resolved before keying
+    assert xy(nx=5, ny=6, indexing=dict(xy='xy'))[0] is xx
+    assert xy(nx=5, ny=6, indexing='ij')[0].shape == (5, 6)
+
+    # int and float arguments give different dtypes, so they are keyed apart
+    assert planar(squeeze=False, z=0)[2].dtype != planar(squeeze=False, z=0.)[2].dtype
+
+    # arrays passed through are copied before being frozen
+    z_ = np.zeros(3)
+    assert planar(squeeze=True, z=z_)[2] is not z_
+    assert z_.flags.writeable
+
+    grid_cache.max_bytes = xx.nbytes + yy.nbytes
+    assert grid_cache.info()['nbytes'] <= grid_cache.max_bytes
+    x, y, z = shell(ntheta=100, nphi=100)
+    assert grid_cache.info()['nbytes'] <= grid_cache.max_bytes
+    assert shell(ntheta=100, nphi=100)[0] is not x
+
+    grid_cache.max_bytes = 256*2**20
+    grid_cache.clear()
+
+
+def test_sparse_grids():
+    shapes = {(xy, True): [(1, 51), (52, 1), ()],
+              (xy, False): [(1, 51, 1), (52, 1, 1), (1, 1, 1)],
+              (xz, True): [(1, 51), (), (53, 1)],
+              (xz, False): [(1, 51, 1), (1, 1, 1), (1, 1, 53)],
+              (yz, True): [(), (1, 52), (53, 1)],
+              (yz, False): [(1, 1, 1), (52, 1, 1), (1, 1, 53)]}
+    for grid, intercept in ((xy, dict(z=0.5)), (xz, dict(y=0.5)), (yz, dict(x=0.5))):
+        for squeeze in (True, False):
+            dense = grid(squeeze=squeeze, **intercept)
+            sparse = grid(squeeze=squeeze, sparse=True, **intercept)
+            assert [np.shape(_) for _ in sparse] == shapes[grid, squeeze]
+            for a, b in zip(np.broadcast_arrays(*dense), np.broadcast_arrays(*sparse)):
+                assert np.array_equal(a, b)
+
+    shapes = {('xy', True): [(1, 10), (11, 1), ()],
+              ('xy', False): [(1, 10, 1), (11, 1, 1), (1, 1, 1)],
+              ('xz', True): [(1, 10), (), (12, 1)],
+              ('xz', False): [(1, 10, 1), (1, 1, 1), (1, 1, 12)],
+              ('yz', True): [(), (1, 11), (12, 1)],
+              ('yz', False): [(1, 1, 1), (11, 1, 1), (1, 1, 12)]}
+    for plane in ('xy', 'xz', 'yz'):
+        for squeeze in (True, False):
+            dense = planar(plane, squeeze=squeeze, nx=10, ny=11, nz=12)
+            sparse = planar(plane, squeeze=squeeze, sparse=True, nx=10, ny=11, nz=12)
+            assert [np.shape(_) for _ in sparse] == shapes[plane, squeeze]
+            for a, b in zip(np.broadcast_arrays(*dense), np.broadcast_arrays(*sparse)):
+                assert np.array_equal(a, b)
+
+    # x and y of a shell depend on both surface axes, so only z is smaller
+    shapes = {('theta-phi', True): [(7, 6), (7, 6), (1, 6)],
+              ('theta-phi', False): [(6, 1, 7), (6, 1, 7), (6, 1, 1)],
+              ('r-theta', True): [(6, 5), (6, 5), (6, 5)],
+              ('r-theta', False): [(6, 5, 1), (6, 5, 1), (6, 5, 1)],
+              ('r-phi', True): [(7, 5), (7, 5), (1, 5)],
+              ('r-phi', False): [(1, 5, 7), (1, 5, 7), (1, 5, 1)]}
+    for mode in ('theta-phi', 'r-theta', 'r-phi'):
+        for squeeze in (True, False):
+            dense = shell(mode, squeeze=squeeze, theta=1., nr=5, ntheta=6, nphi=7)
+            sparse = shell(mode, squeeze=squeeze, sparse=True, theta=1., nr=5, ntheta=6, nphi=7)
+            assert [np.shape(_) for _ in sparse] == shapes[mode, squeeze]
+            for a, b in zip(dense, np.broadcast_arrays(*sparse)):
+                assert np.allclose(a, b)
+
+    f = lambda x, y, z: x + 2*y + 3*z
+    assert np.array_equal(f(**plot_dict(f, planar(squeeze=False))),
+                          f(**plot_dict(f, planar(squeeze=False, sparse=True))))
+
+
+def test_evaluate_on():
+    calls = []
+    def rho(x, y, z):
+        calls.append(np.broadcast(x, y, z).size)
+        return np.sin(5*x)*np.cos(7*y)*z
+
+    expected = rho(**plot_dict(rho, planar('xy', squeeze=False, z=2, nx=30, ny=40)))
+    calls.clear()
+    result = evaluate_on(rho, planar, tile=100, plane='xy', squeeze=False, z=2, nx=30, ny=40)
+    assert np.allclose(result, expected)
+    assert max(calls) <= 100
+
+    expected = rho(**plot_dict(rho, shell(ntheta=60, nphi=70)))
+    for workers in (1, 3):
+        result = evaluate_on(rho, shell, tile=500, workers=workers, ntheta=60, nphi=70)
+        assert np.allclose(result, expected)
+
+    f = lambda x, y, z: x*y*z
+    assert np.allclose(evaluate_on(f, shell_geo, tile=10), f(*shell_geo()))
+    for mode in ('r-theta', 'h-lon'):
+        for squeeze in (True, False):
+            grid_fn = shell if mode == 'r-theta' else shell_geo
+            expected = f(*grid_fn(mode, squeeze=squeeze, indexing='ij'))
+            result = evaluate_on(f, grid_fn, tile=50, shell=mode, squeeze=squeeze, indexing='ij')
+            assert np.allclose(result, expected)
+
+    # shells are tiled on their axes, so memory beyond the output stays within a few tiles
+    import tracemalloc
+    grid_cache.clear()
+    tracemalloc.start()
+    try:
+        result = evaluate_on(f, shell, tile=2000, ntheta=300, nphi=400)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert result.shape == (400, 300)
+    assert peak < result.nbytes + 20*8*2000
+    assert grid_cache.info()['nbytes'] == 0
+
+    assert evaluate_on(lambda x: 2*x, lambda: (3.,)) == 6
@@ -0,0 +1,117 @@
+from itertools import chain
+from scipy.spatial import cKDTree
+import numpy as np
+
+from kamodo_geometry.coordinates import get_transform
+
+
+# # Spatial index
+#
+# A k-d tree over scattered cartesian positions, for example model output
+# converted with `Geographic.xvec`. Queries take (..., 3) positions or the
+# (x, y, z) grids returned by the generators in `space.py`, so lookups cost
+# O((N + M) log N) instead of comparing every pair.
+
+def grid_points(grid):
+    """(..., 3) positions of an (x, y, z) grid, broadcasting sparse axes"""
+    if isinstance(grid, (tuple, list)):
+        return np.stack(np.broadcast_arrays(*grid), axis=-1)
+    return np.asarray(grid)
+
+
+class PointIndex(object):
+    """k-d tree over (..., 3) cartesian positions
+
+    example:
+        >>> index = PointIndex(Geographic().xvec(hvec))
+        >>> distance, nearest = index.query(shell(r=7e6), k=4)
+
+    Returned indices refer to the flattened source positions; use
+    np.unravel_index(indices, index.shape) for the original layout.
+    """
+    def __init__(self, xvec, leafsize=16):
+        xvec = np.asarray(xvec)
+        self.shape = xvec.shape[:-1]
+        self.points = xvec.reshape((-1, 3))
+        self.tree = cKDTree(self.points, leafsize=leafsize)
+
+    @classmethod
+    def from_rvec(cls, rvec, **kwargs):
+        """index spherical (r, theta, phi) positions"""
+        return cls(get_transform('spherical', 'cartesian')(rvec), **kwargs)
+
+    @classmethod
+    def from_hvec(cls, hvec, **kwargs):
+        """index geographic (lon, lat, alt) positions"""
+        return cls(get_transform('geographic', 'cartesian')(hvec), **kwargs)
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, points, k=1, distance_upper_bound=np.inf, workers=1):
+        """distances and indices of the k nearest source positions
+
+        Results have the shape of points without the last axis, plus a
+        trailing axis of length k if k > 1. Missing neighbors have infinite
+        distance and index len(self).
+        """
+        points = grid_points(points)
+        distance, index = self.tree.query(points.reshape((-1, 3)), k=k,
+                                          distance_upper_bound=distance_upper_bound,
+                                          workers=workers)
+        shape = points.shape[:-1] + np.shape(distance)[1:]
+        return distance.reshape(shape), index.reshape(shape)
+
+    def query_radius(self, points, radius, return_distance=False, workers=1):
+        """source positions within radius of each of the flattened points
+
+        Returns (indptr, indices) in compressed sparse row form, where the
+        neighbors of point i are indices[indptr[i]:indptr[i+1]], sorted by
+        index. With return_distance, their distances are returned as well.
+        """
+        points = grid_points(points).reshape((-1, 3))
+        neighbors = self.tree.query_ball_point(points, radius, workers=workers,
+                                               return_sorted=True)
+        counts = np.fromiter(map(len, neighbors), dtype=np.intp, count=len(neighbors))
+        indptr = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.fromiter(chain.from_iterable(neighbors), dtype=np.intp, count=indptr[-1])
+        if not return_distance:
+            return indptr, indices
+        rows = np.repeat(np.arange(len(points)), counts)
+        distance = np.linalg.norm(self.points[indices] - points[rows], axis=-1)
+        return indptr, indices, distance
+
+
+def test_point_index():
+    from kamodo_geometry.space import shell, planar
+    random = np.random.RandomState(0)
+    xvec = random.uniform(-2, 2, (40, 50, 3))
+    index = PointIndex(xvec)
+    assert len(index) == 2000 and index.shape == (40, 50)
+
+    grid = shell(r=1.5, ntheta=9, nphi=11, sparse=True)
+    targets = grid_points(grid)
+    assert targets.shape == (11, 9, 3)
+    brute = np.linalg.norm(targets[..., None, :] - index.points, axis=-1)
+
+    distance, nearest = index.query(grid, k=3)
+    assert distance.shape == nearest.shape == (11, 9, 3)
+    assert np.allclose(distance, np.sort(brute, axis=-1)[..., :3])
+    distance, nearest = index.query(targets)
+    assert (nearest == brute.argmin(axis=-1)).all()
+    assert np.allclose(xvec[np.unravel_index(nearest, index.shape)], index.points[nearest])
+
+    indptr, indices, distance = index.query_radius(grid, 0.3, return_distance=True)
+    flat = brute.reshape((-1, len(index)))
+    for i, row in enumerate(flat):
+        assert (indices[indptr[i]:indptr[i+1]] == np.flatnonzero(row <= 0.3)).all()
+    assert np.allclose(distance, flat[np.repeat(np.arange(len(flat)), np.diff(indptr)), indices])
+
+    # planes and other representations
+    distance, _ = index.query(planar('xy', z=0.5, nx=5, ny=6))
+    assert distance.shape == (6, 5)
+    rvec = get_transform('cartesian', 'spherical')(xvec)
+    assert np.allclose(PointIndex.from_rvec(rvec).points, index.points)
+    hvec = get_transform('cartesian', 'geographic')(xvec)
+    assert np.allclose(PointIndex.from_hvec(hvec).points, index.points)
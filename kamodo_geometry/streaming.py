@@ -0,0 +1,255 @@
+import numpy as np
+
+
+# # Streaming conversions
+#
+# Convert position arrays that do not fit in memory by applying any of the
+# `xvec`/`rvec`/`hvec` conversions of `Spherical`, `Cartesian` or `Geographic`
+# one chunk at a time. Peak memory is bounded by `chunk_size` rows rather than
+# the size of the input.
+
+def iter_chunks(vec, chunk_size=2**20):
+    """yield consecutive slices of vec along its first axis
+
+    vec may be a numpy array or a memory-mapped array, in which case only
+    the pages of the current chunk are read.
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be positive, got {}'.format(chunk_size))
+    for start in range(0, len(vec), chunk_size):
+        yield vec[start:start + chunk_size]
+
+
+def convert_chunks(func, chunks):
+    """lazily apply a vector conversion to an iterable of position chunks
+
+    example:
+        >>> for rvec in convert_chunks(Cartesian().rvec, iter_chunks(xvec, 1000)):
+        ...     process(rvec)
+    """
+    for chunk in chunks:
+        yield func(np.asarray(chunk))
+
+
+def convert_into(func, vec, out=None, chunk_size=2**20):
+    """apply a vector conversion chunk by chunk, writing into out
+
+    out must have the same leading dimension as vec. If out is None it is
+    allocated from the shape and dtype of the first converted chunk.
+    """
+    chunks = convert_chunks(func, iter_chunks(vec, chunk_size))
+    for start, result in zip(range(0, len(vec), chunk_size), chunks):
+        if out is None:
+            out = np.empty((len(vec),) + result.shape[1:], dtype=result.dtype)
+        out[start:start + len(result)] = result
+    return out
+
+
+def convert_npy(func, src, dst, chunk_size=2**20):
+    """convert the positions stored in the .npy file src into the .npy file dst
+
+    src is memory-mapped read-only and dst is written through a memory map,
+    so neither file is ever fully loaded. Returns the memory-mapped output.
+    """
+    vec = np.load(src, mmap_mode='r')
+    if len(vec) == 0:
+        raise ValueError('cannot convert empty file {}'.format(src))
+    # the first chunk determines the output's trailing shape and dtype
+    probe = func(np.asarray(vec[:1]))
+    out = np.lib.format.open_memmap(
+        dst, mode='w+', dtype=probe.dtype, shape=(len(vec),) + probe.shape[1:])
+    convert_into(func, vec, out, chunk_size)
+    out.flush()
+    return out
+
+
+# ## Trajectories
+#
+# Real-time positions are kept over a sliding window in all three
+# representations. Only newly appended samples are converted, straight into
+# preallocated ring buffers. Each buffer holds two copies of the ring, so
+# that any window of the latest samples is one contiguous, zero-copy slice.
+
+vector_names = ('xvec', 'rvec', 'hvec')
+
+
+class Trajectory(object):
+    """the latest capacity positions in cartesian, spherical and geographic form
+
+    example:
+        >>> track = Trajectory(Cartesian(), capacity=86400)
+        >>> track.append(xvec_new, t_new)
+        >>> window = track.window(since=t_now - np.timedelta64(6, 'h'))
+        >>> window['hvec'] # (n, 3) view, oldest first
+
+    coords is a Spherical, Cartesian or Geographic object: appended vectors
+    are in its input form and converted with its vector conversions, keeping
+    its component orders, dtype and ellipsoid. Appending n samples costs
+    O(n) regardless of capacity. Views are read-only and reflect later
+    appends, which overwrite the oldest samples; copy them to keep them.
+    """
+    def __init__(self, coords, capacity, dtype=None):
+        if capacity < 1:
+            raise ValueError('capacity must be positive, got {}'.format(capacity))
+        self.coords = coords
+        self.capacity = capacity
+        self.kernels = dict(coords.kernels)
+        self.input = next(_ for _ in vector_names if _ not in self.kernels)
+        self.dtype = np.dtype(dtype or getattr(coords, 'dtype', None) or float)
+        self.buffers = {name: np.empty((2*capacity, 3), dtype=self.dtype)
+                        for name in vector_names}
+        self.times = None
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, vec, t=None):
+        """convert and store (n, 3) positions in the input form, with optional times t"""
+        vec = np.asarray(vec)
+        if vec.ndim != 2 or vec.shape[1] != 3:
+            raise ValueError('vec has shape {}, expected (n, 3)'.format(vec.shape))
+        if t is not None:
+            t = np.asarray(t)
+            if t.shape != vec.shape[:1]:
+                raise ValueError('t has shape {}, expected {}'.format(t.shape, vec.shape[:1]))
+            if self.times is None:
+                if self.count:
+                    raise ValueError('times must be given from the first append')
+                self.times = np.empty(2*self.capacity, dtype=t.dtype)
+        elif self.times is not None:
+            raise ValueError('times are required after the first append with times')
+
+        # older samples would be overwritten within this same append
+        skipped = max(0, len(vec) - self.capacity)
+        start = self.count + skipped
+        position = start % self.capacity
+        done = skipped
+        while done < len(vec):
+            n = min(len(vec) - done, self.capacity - position)
+            self.store(position, vec[done:done + n], None if t is None else t[done:done + n])
+            done += n
+            position = 0
+        self.count += len(vec)
+
+    def store(self, position, vec, t):
+        """write n samples at ring slots position:position+n and their mirror"""
+        n = len(vec)
+        rows = slice(position, position + n)
+        mirror = slice(position + self.capacity, position + self.capacity + n)
+        self.buffers[self.input][rows] = vec
+        for name, kernel in self.kernels.items():
+            kernel(self.buffers[self.input][rows], out=self.buffers[name][rows])
+        for buffer in self.buffers.values():
+            buffer[mirror] = buffer[rows]
+        if t is not None:
+            self.times[rows] = t
+            self.times[mirror] = t
+
+    def view(self, name, n=None):
+        """read-only view of the latest n (default all) samples of buffer name"""
+        n = len(self) if n is None else min(n, len(self))
+        start = (self.count - n) % self.capacity
+        buffer = self.times if name == 't' else self.buffers[name]
+        view = buffer[start:start + n]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def xvec(self):
+        return self.view('xvec')
+
+    @property
+    def rvec(self):
+        return self.view('rvec')
+
+    @property
+    def hvec(self):
+        return self.view('hvec')
+
+    @property
+    def t(self):
+        if self.times is None:
+            return None
+        return self.view('t')
+
+    def window(self, since=None, n=None):
+        """views of the samples at or after time since, or of the latest n
+
+        Returns a dictionary of t, xvec, rvec and hvec, oldest first. Times
+        must be appended in increasing order for since to apply.
+        """
+        if since is not None:
+            if self.times is None:
+                raise ValueError('trajectory has no times')
+            n = len(self) - np.searchsorted(self.view('t'), since)
+        window = {name: self.view(name, n) for name in vector_names}
+        window['t'] = None if self.times is None else self.view('t', n)
+        return window
+
+
+def test_streaming(tmp_path):
+    from kamodo_geometry.coordinates import Cartesian, Geographic
+    cartesian = Cartesian(rvec_order=['phi', 'theta', 'r'])
+    geographic = Geographic()
+
+    xvec = np.random.RandomState(0).uniform(-1, 1, (1003, 3))
+    expected = cartesian.rvec(xvec)
+
+    chunks = list(convert_chunks(cartesian.rvec, iter_chunks(xvec, 100)))
+    assert len(chunks) == 11
+    assert np.allclose(np.concatenate(chunks), expected)
+
+    assert np.allclose(convert_into(cartesian.rvec, xvec, chunk_size=100), expected)
+
+    out = np.zeros_like(xvec)
+    assert convert_into(cartesian.rvec, xvec, out, chunk_size=7) is out
+    assert np.allclose(out, expected)
+
+    hvec = np.stack((np.linspace(-180, 180, 500),
+                     np.linspace(-90, 90, 500),
+                     np.linspace(0, 1000, 500)), axis=-1)
+    src = str(tmp_path / 'hvec.npy')
+    dst = str(tmp_path / 'xvec.npy')
+    np.save(src, hvec)
+    convert_npy(geographic.xvec, src, dst, chunk_size=64)
+    assert np.allclose(np.load(dst), geographic.xvec(hvec))
+
+
+def test_trajectory():
+    from kamodo_geometry.coordinates import Cartesian, Geographic
+    cartesian = Cartesian(hvec_order=['alt', 'lat', 'lon'])
+    random = np.random.RandomState(0)
+    xvec = random.uniform(-1e7, 1e7, (1000, 3))
+    t = np.datetime64('2024-01-01') + np.arange(1000).astype('timedelta64[s]')
+
+    track = Trajectory(cartesian, capacity=300)
+    assert track.input == 'xvec' and len(track) == 0
+    for start, end in [(0, 7), (7, 250), (250, 333), (333, 334), (334, 650), (650, 1000)]:
+        track.append(xvec[start:end], t[start:end])
+        latest = slice(max(0, end - 300), end)
+        assert len(track) == end - latest.start
+        assert np.array_equal(track.xvec, xvec[latest])
+        assert np.allclose(track.rvec, cartesian.rvec(xvec[latest]))
+        assert np.allclose(track.hvec, cartesian.hvec(xvec[latest]))
+        assert np.array_equal(track.t, t[latest])
+
+    # windows are read-only views into the buffers
+    window = track.window(since=t[900])
+    assert len(window['hvec']) == 100 and window['t'][0] == t[900]
+    assert np.shares_memory(window['rvec'], track.buffers['rvec'])
+    assert not window['xvec'].flags.writeable
+    assert np.array_equal(track.window(n=5)['xvec'], xvec[-5:])
+
+    hvec = cartesian.hvec(xvec)[:, ::-1]
+    geo = Trajectory(Geographic(), capacity=64, dtype=np.float32)
+    geo.append(hvec)
+    assert geo.input == 'hvec' and geo.xvec.dtype == np.float32
+    assert np.allclose(geo.xvec, xvec[-64:], rtol=1e-5, atol=10)
+    assert geo.t is None
+    try:
+        geo.append(hvec[:2], t[:2])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('times cannot start after the first append')